@@ -0,0 +1,117 @@
+# ACTIONS
+# Runs the Lambda functions behind "reasmb: lambda <name> [fallback reply]".
+# Actions are declared with optional "lambda: <name> [event] [timeout <s>]
+# [cache <s>]" script lines and resolved once at load time. Each call has a
+# deadline; when it passes, or the call fails, the turn uses the fallback
+# reply instead of waiting. Event actions are fired and not waited for, and
+# cached actions reuse a recent answer for the same text, whichever session
+# asked: only cache actions whose answer doesn't depend on the user.
+# LocalInvoker runs python callables in place of Lambda, for offline use.
+
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from comprehend import ResultCache
+
+log = logging.getLogger(__name__)
+
+
+class Action:
+    def __init__(self, name, target, event=False, timeout=None, cache_ttl=0):
+        self.name = name
+        self.target = target
+        self.event = event
+        self.timeout = timeout
+        self.cache = ResultCache(capacity=256, ttl=cache_ttl) if cache_ttl else None
+
+
+#builds an Action from the content of a lambda: line, or just a name
+#the target is the ARN in the environment variable of the same name, or the name
+def parse_action(content, default_timeout):
+    parts = content.split(' ')
+    name = parts[0]
+    event = False
+    timeout = default_timeout
+    cache_ttl = 0
+    options = iter(parts[1:])
+    for option in options:
+        if option == 'event':
+            event = True
+        elif option == 'timeout':
+            timeout = float(next(options))
+        elif option == 'cache':
+            cache_ttl = float(next(options))
+        elif option:
+            raise ValueError("Unknown option {} for lambda {}".format(option, name))
+    return Action(name, os.environ.get(name, name), event, timeout, cache_ttl)
+
+
+class LambdaInvoker:
+    # client is a lambda client, shared so its connection pool is reused
+    # connect: called for the client on the first invoke, when client isn't given
+    def __init__(self, client=None, connect=None):
+        self._client = client
+        self.connect = connect
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.connect()
+        return self._client
+
+    def invoke(self, action, payload):
+        response = self.client.invoke(
+            FunctionName=action.target,
+            InvocationType='Event' if action.event else 'RequestResponse',
+            Payload=json.dumps(payload)
+        )
+        if action.event:
+            return None
+        return json.loads(response['Payload'].read())['body']
+
+
+class LocalInvoker:
+    # handlers: {action name: callable(payload) -> body}
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.calls = []
+
+    def invoke(self, action, payload):
+        self.calls.append((action.name, payload))
+        return self.handlers[action.name](payload)
+
+
+class ActionExecutor:
+    def __init__(self, invoker, workers=8):
+        self.invoker = invoker
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    #returns the body of the action, or None when the caller should fall back:
+    #an event action, a missed deadline or a failed call
+    def run(self, action, payload):
+        if action.cache is not None:
+            key = (action.name, payload.get('text'))
+            body = action.cache.get(key)
+            if body is not None:
+                return body
+        future = self.pool.submit(self.invoker.invoke, action, payload)
+        if action.event:
+            future.add_done_callback(self._log_failure)
+            return None
+        try:
+            body = future.result(timeout=action.timeout)
+        except TimeoutError:
+            log.warning('Lambda %s missed its %ss deadline', action.name, action.timeout)
+            return None
+        except Exception:
+            log.exception('Lambda %s failed', action.name)
+            return None
+        if action.cache is not None and body is not None:
+            action.cache.put(key, body)
+        return body
+
+    def _log_failure(self, future):
+        if future.exception() is not None:
+            log.warning('Event lambda failed: %s', future.exception())
@@ -0,0 +1,40 @@
+# AWS CLIENTS
+# boto3 is imported, and each client created, the first time a feature
+# needs it, so a deployment only pays at startup for the features it uses
+# and the engine imports without the AWS SDK installed. Clients are cached
+# per process: a forked worker starts with none and creates its own, as
+# boto3 clients can't be shared across a fork.
+#
+#   aws.client('comprehend', region_name='us-east-1').detect_sentiment(...)
+
+import os
+import threading
+
+_clients = {}
+_lock = threading.Lock()
+
+
+#the cached client for service; kwargs only apply when it is first created
+def client(service, **kwargs):
+    found = _clients.get(service)
+    if found is None:
+        with _lock:
+            found = _clients.get(service)
+            if found is None:
+                import boto3
+                found = _clients[service] = boto3.client(service_name=service, **kwargs)
+    return found
+
+
+#builds a botocore Config, without importing botocore until it is needed
+def config(**kwargs):
+    from botocore.config import Config
+    return Config(**kwargs)
+
+
+def forget():
+    _clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget)
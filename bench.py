@@ -0,0 +1,489 @@
+# HIGGINS BENCHMARK
+# Replays synthetic and recorded transcripts through the V1 and V2 engines
+# with stubbed AWS clients, and reports cold-load time, per-turn latency,
+# throughput and allocations side by side.
+#
+#   python bench.py                         # both engines, all transcripts
+#   python bench.py --engines v2 --save bench.json
+#   python bench.py --compare bench.json    # exit 1 on a regression
+#   python bench.py --scaling 4             # v2 throughput with 1, 2 and 4 worker processes
+#
+# Recorded transcripts are the .txt files in transcripts/, one user turn per line.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+GREETINGS = ['hello', 'hi', 'hey there', 'hello higgins', 'yes', 'no', 'sorry', 'bye']
+
+#words the core script keys and decomps react to, for the long inputs
+RAMBLE = ('i you my me am are was remember believe if dreamed your can why everyone '
+          'like the a and so then really think want need sad happy mother family '
+          'computer dream because always what were it that just').split()
+
+#inputs whose keys answer with goto chains
+GOTO = ['I think so', 'apologise', 'everybody hates me', 'nobody likes me', 'covid',
+        'coronavirus is scary', 'why', 'i dreamed i was flying', 'deutsch',
+        'you remind me of my dog', 'it is like a cat', 'noone calls me']
+
+
+def synthetic(seed, turns):
+    rng = random.Random(seed)
+    ramble = []
+    for _ in range(turns):
+        length = rng.randint(40, 120)
+        words = [rng.choice(RAMBLE) for _ in range(length)]
+        # sprinkle punctuation so the cleanup passes have work to do
+        for position in range(rng.randint(2, 8)):
+            words[rng.randrange(length)] += rng.choice([',', '.', ';'])
+        ramble.append(' '.join(words))
+    return {
+        'greetings': [rng.choice(GREETINGS) for _ in range(turns)],
+        'rambling': ramble,
+        'goto': [rng.choice(GOTO) for _ in range(turns)],
+    }
+
+
+def recorded():
+    transcripts = {}
+    for path in sorted((ROOT / 'transcripts').glob('*.txt')):
+        with open(path) as file:
+            transcripts[path.stem] = [line.strip() for line in file if line.strip()]
+    return transcripts
+
+
+#in-memory stand-ins for the boto3 clients the engines create at import
+
+class FakeBody(io.BytesIO):
+    pass
+
+
+class FakeS3:
+    # objects: {key: path}, served like list_objects_v2/get_object
+    def __init__(self, objects):
+        self.objects = objects
+        self.meta = types.SimpleNamespace(client=self)
+
+    def _read(self, key):
+        with open(self.objects[key], 'rb') as file:
+            data = file.read()
+        return data, hashlib.md5(data).hexdigest()
+
+    def get_paginator(self, name):
+        fake = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                contents = [{'Key': key, 'ETag': '"{}"'.format(fake._read(key)[1])}
+                            for key in sorted(fake.objects) if key.startswith(Prefix)]
+                return [{'Contents': contents}]
+        return Paginator()
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        data, etag = self._read(Key)
+        return {'Body': FakeBody(data), 'ETag': '"{}"'.format(etag)}
+
+
+class FakeLambda:
+    def invoke(self, FunctionName, InvocationType, **kwargs):
+        return {'Payload': FakeBody(json.dumps({'body': 'lambda ' + FunctionName}).encode())}
+
+
+def install_fakes():
+    from comprehend import FakeComprehend
+    objects = {'script.txt': str(ROOT / 'scripts/core/script.txt')}
+    for path in sorted((ROOT / 'scripts/core').iterdir()):
+        objects['scripts/core/' + path.name] = str(path)
+    s3 = FakeS3(objects)
+
+    def client(service_name=None, *args, **kwargs):
+        service_name = service_name or args[0]
+        if service_name == 'comprehend':
+            return FakeComprehend(sentiments={'sad': 'NEGATIVE', 'happy': 'POSITIVE'})
+        if service_name == 'lambda':
+            return FakeLambda()
+        return s3
+
+    boto3 = types.ModuleType('boto3')
+    boto3.client = client
+    boto3.resource = lambda *args, **kwargs: s3
+    sys.modules['boto3'] = boto3
+    botocore = types.ModuleType('botocore')
+    botocore.exceptions = types.ModuleType('botocore.exceptions')
+    botocore.exceptions.ClientError = type('ClientError', (Exception,), {})
+    botocore.config = types.ModuleType('botocore.config')
+    botocore.config.Config = lambda **kwargs: kwargs
+    sys.modules['botocore'] = botocore
+    sys.modules['botocore.exceptions'] = botocore.exceptions
+    sys.modules['botocore.config'] = botocore.config
+    # the engines must not pick up a developer's .env while benchmarking
+    dotenv = types.ModuleType('dotenv')
+    dotenv.load_dotenv = lambda *args, **kwargs: None
+    sys.modules['dotenv'] = dotenv
+
+
+class V2Engine:
+    name = 'v2'
+
+    def __init__(self, scratch):
+        os.environ['script_cache'] = os.path.join(scratch, 'cache')
+        os.environ['bundle_path'] = os.path.join(scratch, 'higgins.bundle')
+        os.chdir(str(ROOT))
+        with contextlib.redirect_stdout(io.StringIO()):
+            import higginsV2
+            higginsV2.init('local')
+        self.module = higginsV2
+        self.higgins = None
+
+    def load(self):
+        self.higgins = self.module.Higgins()
+        self.higgins.load_local()
+
+    # cold load from a fresh precompiled bundle instead of the text scripts
+    def load_bundled(self):
+        self.module.compile_bundle('local')
+        try:
+            started = time.perf_counter()
+            self.load()
+            return time.perf_counter() - started
+        finally:
+            os.remove(self.module.bundle_path)
+
+    def conversation(self):
+        from sessions import Session
+        session = Session('bench')
+        return lambda text: self.higgins.respond(text, session)
+
+
+class V1Engine:
+    name = 'v1'
+
+    def __init__(self, scratch):
+        # v1 loads script.txt and then every file directly in scripts/
+        self.directory = os.path.join(scratch, 'v1')
+        os.makedirs(os.path.join(self.directory, 'scripts'))
+        shutil.copy(str(ROOT / 'scripts/core/script.txt'), self.directory)
+        for folder in ('core', 'addons'):
+            for path in (ROOT / 'scripts' / folder).iterdir():
+                if path.name != 'script.txt':
+                    shutil.copy(str(path), os.path.join(self.directory, 'scripts'))
+        os.chdir(self.directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import higginsV1
+        self.module = higginsV1
+        self.higgins = None
+
+    def load(self):
+        os.chdir(self.directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.higgins = self.module.Higgins()
+            self.higgins.load('script.txt')
+
+    def conversation(self):
+        self.higgins.stm = []
+        return self.higgins.respond
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+#errors is a list the failed turns are added to, as 'text: exception'
+def replay(engine, turns, errors):
+    respond = engine.conversation()
+    latencies = []
+    started = time.perf_counter()
+    for text in turns:
+        turn_started = time.perf_counter()
+        try:
+            respond(text)
+        except Exception as e:
+            # a broken turn still costs its time, it is counted and fails the run
+            errors.append('{!r}: {!r}'.format(text, e))
+        latencies.append(time.perf_counter() - turn_started)
+    elapsed = time.perf_counter() - started
+    return latencies, elapsed
+
+
+def allocations(engine, turns, errors):
+    respond = engine.conversation()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for text in turns:
+        try:
+            respond(text)
+        except Exception as e:
+            errors.append('{!r}: {!r}'.format(text, e))
+    after = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return peak, blocks
+
+
+def bench(engine, workloads, repeat, loads):
+    result = {'load_ms': None, 'workloads': {}}
+    times = []
+    for _ in range(loads):
+        started = time.perf_counter()
+        engine.load()
+        times.append(time.perf_counter() - started)
+    result['load_ms'] = round(min(times) * 1000, 3)
+    if hasattr(engine, 'load_bundled'):
+        bundled = min(engine.load_bundled() for _ in range(loads))
+        result['bundle_load_ms'] = round(bundled * 1000, 3)
+    for name, turns in workloads.items():
+        latencies = []
+        errors = []
+        elapsed = 0.0
+        for _ in range(repeat):
+            run, seconds = replay(engine, turns, errors)
+            latencies.extend(run)
+            elapsed += seconds
+        peak, blocks = allocations(engine, turns, errors)
+        result['workloads'][name] = {
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'turns': len(latencies),
+            'p50_us': round(percentile(latencies, 0.5) * 1e6, 1),
+            'p99_us': round(percentile(latencies, 0.99) * 1e6, 1),
+            'turns_per_sec': round(len(latencies) / elapsed, 1),
+            'peak_kib': round(peak / 1024.0, 1),
+            'blocks_per_turn': round(blocks / float(len(turns)), 1),
+        }
+    return result
+
+
+#turns/sec of many concurrent sessions answered by 1, 2, 4 ... up to processes workers
+def scaling(engine, texts, processes, sessions=64):
+    from workers import WorkerPool
+    counts = []
+    count = 1
+    while count < processes:
+        counts.append(count)
+        count *= 2
+    counts.append(processes)
+    rows = []
+    for count in counts:
+        pool = WorkerPool(engine.module.converse, count, prepare=engine.module.open_sessions)
+        try:
+            # a warm up turn per worker, so forking isn't timed
+            for index in range(count * 4):
+                pool.converse('warmup-{}'.format(index), 'hello')
+            with ThreadPoolExecutor(max_workers=count * 2) as clients:
+                started = time.perf_counter()
+                list(clients.map(lambda item: pool.converse('bench-{}'.format(item[0] % sessions), item[1]),
+                                 enumerate(texts)))
+                elapsed = time.perf_counter() - started
+        finally:
+            pool.close()
+        rows.append({'processes': count, 'turns_per_sec': round(len(texts) / elapsed, 1)})
+    for row in rows:
+        row['speedup'] = round(row['turns_per_sec'] / rows[0]['turns_per_sec'], 2)
+    return rows
+
+
+#run in a fresh interpreter, so nothing is imported already
+IMPORT_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import {}
+elapsed = time.perf_counter() - started
+print(json.dumps({{'import_ms': round(elapsed * 1000, 1), 'boto3': 'boto3' in sys.modules,
+                  'modules': len(sys.modules)}}))
+'''
+
+
+#modules that must import without boto3, the aws clients are made on first use
+LAZY_MODULES = ('higginsV2', 'server')
+
+
+#cold import time of each module, the fastest of runs, and whether it pulled in boto3
+def imports(modules, runs):
+    rows = {}
+    for module in modules:
+        best = None
+        for _ in range(runs):
+            done = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module)], cwd=str(ROOT),
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if done.returncode:
+                lines = done.stderr.strip().splitlines()
+                best = {'error': lines[-1] if lines else 'exit {}'.format(done.returncode)}
+                break
+            row = json.loads(done.stdout.strip().splitlines()[-1])
+            if best is None or row['import_ms'] < best['import_ms']:
+                best = row
+        rows[module] = best
+    return rows
+
+
+#modules that failed to import, or pulled in boto3 when they shouldn't
+def import_problems(rows):
+    found = []
+    for module, row in rows.items():
+        if 'error' in row:
+            found.append('{}: import failed: {}'.format(module, row['error']))
+        elif row['boto3'] and module in LAZY_MODULES:
+            found.append('{}: imports boto3 at startup'.format(module))
+    return found
+
+
+#modules whose import time grew by more than tolerance over the saved run
+def import_regressions(rows, saved, tolerance):
+    found = []
+    for module, row in rows.items():
+        before = saved.get(module)
+        if before and 'import_ms' in row and 'import_ms' in before:
+            if row['import_ms'] > before['import_ms'] * (1 + tolerance):
+                found.append('{} import: {}ms -> {}ms'.format(module, before['import_ms'], row['import_ms']))
+    return found
+
+
+def report(results):
+    columns = ['p50_us', 'p99_us', 'turns_per_sec', 'peak_kib', 'blocks_per_turn', 'errors']
+    print('{:<6} {:<12} {:>10}'.format('engine', 'workload', 'load_ms') +
+          ''.join('{:>16}'.format(column) for column in columns))
+    for engine, result in results.items():
+        for name, row in result['workloads'].items():
+            print('{:<6} {:<12} {:>10}'.format(engine, name, result['load_ms']) +
+                  ''.join('{:>16}'.format(row[column]) for column in columns))
+    for engine, result in results.items():
+        if 'bundle_load_ms' in result:
+            print('{} load from bundle: {}ms'.format(engine, result['bundle_load_ms']))
+    for engine, result in results.items():
+        for name, row in result['workloads'].items():
+            if row['errors']:
+                print('{} {}: {} failed turns, first {}'.format(engine, name, row['errors'], row['first_error']))
+
+
+#number of turns that raised, a run with any is not a valid measurement
+def failures(results):
+    return sum(row['errors'] for result in results.values() for row in result['workloads'].values())
+
+
+#returns the rows whose p50 grew by more than tolerance over the saved run
+def regressions(results, baseline, tolerance):
+    found = []
+    for engine, result in results.items():
+        saved = baseline.get(engine)
+        if not saved:
+            continue
+        for name, row in result['workloads'].items():
+            before = saved['workloads'].get(name)
+            if before and row['p50_us'] > before['p50_us'] * (1 + tolerance):
+                found.append('{} {}: p50 {}us -> {}us'.format(engine, name, before['p50_us'], row['p50_us']))
+        if result['load_ms'] > saved['load_ms'] * (1 + tolerance):
+            found.append('{} load: {}ms -> {}ms'.format(engine, saved['load_ms'], result['load_ms']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Higgins response pipeline')
+    parser.add_argument('--engines', default='v1,v2')
+    parser.add_argument('--turns', type=int, default=200, help='turns per synthetic workload')
+    parser.add_argument('--repeat', type=int, default=3, help='replays of each workload')
+    parser.add_argument('--loads', type=int, default=5, help='cold loads timed, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='fail if p50 or load time regressed against this json file')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--phrase-matching', choices=('off', 'first', 'each'),
+                        help='v2 phrase matching mode, see higginsV2.phrase_matching')
+    parser.add_argument('--scaling', type=int, metavar='PROCESSES',
+                        help='instead, measure v2 throughput across up to this many worker processes')
+    parser.add_argument('--imports', metavar='MODULES', nargs='?', const=','.join(LAZY_MODULES),
+                        help='instead, time a cold import of these modules in a fresh interpreter')
+    args = parser.parse_args()
+
+    if args.imports:
+        rows = imports(args.imports.split(','), args.loads)
+        print('{:<12} {:>10} {:>8} {:>8}'.format('module', 'import_ms', 'modules', 'boto3'))
+        for module, row in rows.items():
+            if 'error' in row:
+                print('{:<12} {}'.format(module, row['error']))
+            else:
+                print('{:<12} {:>10} {:>8} {:>8}'.format(module, row['import_ms'], row['modules'],
+                                                         'yes' if row['boto3'] else 'no'))
+        if args.save:
+            with open(args.save, 'w') as file:
+                json.dump({'imports': rows}, file, indent=2)
+        found = import_problems(rows)
+        if args.compare:
+            with open(args.compare) as file:
+                found += import_regressions(rows, json.load(file).get('imports', {}), args.tolerance)
+        for line in found:
+            print('REGRESSION ' + line)
+        if found:
+            sys.exit(1)
+        return
+
+    sys.path.insert(0, str(ROOT))
+    install_fakes()
+    workloads = synthetic(args.seed, args.turns)
+    workloads.update(recorded())
+
+    engines = {'v1': V1Engine, 'v2': V2Engine}
+    results = {}
+    scratch = tempfile.mkdtemp(prefix='higgins-bench-')
+    cwd = os.getcwd()
+    if args.scaling:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                rows = scaling(V2Engine(scratch), workloads['rambling'] * args.repeat, args.scaling)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(scratch, ignore_errors=True)
+        print('{:>10} {:>16} {:>10}'.format('processes', 'turns_per_sec', 'speedup'))
+        for row in rows:
+            print('{:>10} {:>16} {:>10}'.format(row['processes'], row['turns_per_sec'], row['speedup']))
+        if args.save:
+            with open(args.save, 'w') as file:
+                json.dump({'scaling': rows}, file, indent=2)
+        return
+    try:
+        # the engines still print from some paths, keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name in args.engines.split(','):
+                random.seed(args.seed)
+                engine = engines[name](scratch)
+                if name == 'v2' and args.phrase_matching:
+                    engine.module.phrase_matching = args.phrase_matching
+                results[name] = bench(engine, workloads, args.repeat, args.loads)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for line in found:
+            print('REGRESSION ' + line)
+        if found:
+            sys.exit(1)
+    if failures(results):
+        print('FAILED {} turns raised, the timings are not valid'.format(failures(results)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
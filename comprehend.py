@@ -0,0 +1,199 @@
+# COMPREHEND
+# Cache in front of the Comprehend calls Higgins makes every turn.
+# Results are kept per normalized text in a bounded LRU with a ttl, and can
+# be persisted to /tmp so a re-initialized container starts warm.
+# FakeComprehend answers like the boto3 client, for running offline.
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+#comprehend batch apis take at most 25 texts per call
+BATCH_SIZE = 25
+
+
+#whitespace differences don't change what comprehend finds; case does, for entities
+def normalize(text):
+    return ' '.join(text.split())
+
+
+class ResultCache:
+    # path: optional json file the cache is loaded from and saved to
+    # every persist_interval seconds
+    def __init__(self, capacity=4096, ttl=3600, path=None, persist_interval=60):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.path = path
+        self.persist_interval = persist_interval
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved = time.time()
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    def get(self, text):
+        with self.lock:
+            entry = self.entries.get(text)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(text)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text, value):
+        with self.lock:
+            self.entries[text] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(text)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        if self.path and time.time() - self.saved > self.persist_interval:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for text, expires, value in entries[-self.capacity:]:
+            if expires > now:
+                self.entries[text] = (expires, value)
+
+    def save(self):
+        with self.lock:
+            entries = [[text, expires, value] for text, (expires, value) in self.entries.items()]
+            self.saved = time.time()
+        directory = os.path.dirname(self.path) or '.'
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as file:
+            json.dump(entries, file)
+        os.replace(temp, self.path)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+class CachedComprehend:
+    # cache_dir: optional directory to persist both caches in
+    # connect: called for the client on the first cache miss, when client isn't given
+    def __init__(self, client=None, capacity=4096, ttl=3600, cache_dir=None, language='en', connect=None):
+        self._client = client
+        self.connect = connect
+        self.language = language
+        entities_path = sentiment_path = None
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            entities_path = os.path.join(cache_dir, 'entities.json')
+            sentiment_path = os.path.join(cache_dir, 'sentiment.json')
+        self.entities = ResultCache(capacity, ttl, entities_path)
+        self.sentiment = ResultCache(capacity, ttl, sentiment_path)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.connect()
+        return self._client
+
+    #returns the Entities list for text
+    def detect_entities(self, text):
+        text = normalize(text)
+        result = self.entities.get(text)
+        if result is None:
+            result = self.client.detect_entities(Text=text, LanguageCode=self.language)['Entities']
+            self.entities.put(text, result)
+        return result
+
+    #returns the Sentiment label for text
+    def detect_sentiment(self, text):
+        text = normalize(text)
+        result = self.sentiment.get(text)
+        if result is None:
+            result = self.client.detect_sentiment(Text=text, LanguageCode=self.language)['Sentiment']
+            self.sentiment.put(text, result)
+        return result
+
+    def batch_detect_entities(self, texts):
+        return self._batch(self.client.batch_detect_entities, self.entities, texts, 'Entities')
+
+    def batch_detect_sentiment(self, texts):
+        return self._batch(self.client.batch_detect_sentiment, self.sentiment, texts, 'Sentiment')
+
+    #looks texts up in the cache and sends the misses to a batch api in chunks
+    #texts comprehend can't take, or that fail, are left as None
+    def _batch(self, method, cache, texts, field):
+        results = [None] * len(texts)
+        missing = {}
+        for position, text in enumerate(texts):
+            text = normalize(text)
+            if not text:
+                continue
+            result = cache.get(text)
+            if result is not None:
+                results[position] = result
+            else:
+                missing.setdefault(text, []).append(position)
+        pending = list(missing)
+        for start in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[start:start + BATCH_SIZE]
+            response = method(TextList=chunk, LanguageCode=self.language)
+            for result in response['ResultList']:
+                text = chunk[result['Index']]
+                cache.put(text, result[field])
+                for position in missing[text]:
+                    results[position] = result[field]
+        return results
+
+    def stats(self):
+        return {'entities': self.entities.stats(), 'sentiment': self.sentiment.stats()}
+
+
+class FakeComprehend:
+    # entities: {text: type} found wherever the text appears
+    # sentiments: {word: label} the first listed word found decides, else default
+    def __init__(self, entities=None, sentiments=None, default='NEUTRAL'):
+        self.entity_types = entities or {}
+        self.sentiments = sentiments or {}
+        self.default = default
+        self.calls = 0
+
+    def _entities(self, text):
+        found = []
+        for name, type in self.entity_types.items():
+            offset = text.find(name)
+            if offset >= 0:
+                found.append({'Text': name, 'Type': type, 'Score': 1.0,
+                              'BeginOffset': offset, 'EndOffset': offset + len(name)})
+        return found
+
+    def _sentiment(self, text):
+        words = text.lower().split()
+        for word, label in self.sentiments.items():
+            if word in words:
+                return label
+        return self.default
+
+    def detect_entities(self, Text, LanguageCode):
+        self.calls += 1
+        return {'Entities': self._entities(Text)}
+
+    def detect_sentiment(self, Text, LanguageCode):
+        self.calls += 1
+        return {'Sentiment': self._sentiment(Text)}
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        self.calls += 1
+        results = [{'Index': i, 'Entities': self._entities(text)} for i, text in enumerate(TextList)]
+        return {'ResultList': results, 'ErrorList': []}
+
+    def batch_detect_sentiment(self, TextList, LanguageCode):
+        self.calls += 1
+        results = [{'Index': i, 'Sentiment': self._sentiment(text)} for i, text in enumerate(TextList)]
+        return {'ResultList': results, 'ErrorList': []}
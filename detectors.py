@@ -0,0 +1,150 @@
+# DETECTORS
+# Entity and sentiment detection behind one interface:
+#   detect_entities(text) -> [{'Text', 'Type', 'Score', ...}]
+#   detect_sentiment(text) -> 'POSITIVE' | 'NEGATIVE' | 'NEUTRAL'
+#   batch_detect_entities(texts), batch_detect_sentiment(texts)
+# comprehend.CachedComprehend is the remote detector. LocalDetector works
+# offline from the entity: and sentiment: lines of the scripts, and
+# FallbackDetector asks the remote one only when the local one is unsure.
+
+import re
+
+#a sentiment word up to NEGATION_SCOPE words after one of these, in the same
+#clause, counts the other way: 'not very happy' is negative
+NEGATION_SCOPE = 3
+NEGATIONS = set(['not', 'no', 'never', "don't", "dont", "isn't", "wasn't", "aren't",
+                 "can't", "cannot", "won't", "didn't", "doesn't", 'hardly'])
+
+WORD = re.compile(r"[A-Za-z][\w'-]*")
+#words, and the punctuation that ends a negation's scope
+WORD_OR_STOP = re.compile(r"[A-Za-z][\w'-]*|[.,;:!?]")
+
+
+class LocalDetector:
+    # gazetteer: [(type, pattern)], a pattern is a phrase or a /regex/
+    # lexicon: {word: label}
+    def __init__(self, gazetteer, lexicon):
+        self.lexicon = dict((word.lower(), label.upper()) for word, label in lexicon.items())
+        phrases = {}
+        self.patterns = []
+        for type, pattern in gazetteer:
+            type = type.upper()
+            if len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/'):
+                self.patterns.append((type, re.compile(pattern[1:-1])))
+            else:
+                phrases.setdefault(type, []).append(pattern)
+        for type, names in phrases.items():
+            # longest first so 'new york city' wins over 'new york'
+            names = sorted(set(names), key=len, reverse=True)
+            alternation = '|'.join(re.escape(name) for name in names)
+            self.patterns.append((type, re.compile(r'\b(?:' + alternation + r')\b', re.IGNORECASE)))
+
+    #returns (entities, confidence), confidence is low when capitalized words
+    #the gazetteer doesn't know could be names
+    def score_entities(self, text):
+        found = []
+        covered = set()
+        for type, pattern in self.patterns:
+            for match in pattern.finditer(text):
+                found.append({'Text': match.group(0), 'Type': type, 'Score': 1.0,
+                              'BeginOffset': match.start(), 'EndOffset': match.end()})
+                covered.update(range(match.start(), match.end()))
+        found.sort(key=lambda e: e['BeginOffset'])
+        confidence = 1.0
+        for match in WORD.finditer(text):
+            word = match.group(0)
+            # I, I'm, I've, I'll, I'd are capitalized anywhere
+            if not word[0].isupper() or word == 'I' or word.startswith("I'") or match.start() in covered:
+                continue
+            before = text[:match.start()].rstrip()
+            if before and before[-1] not in '.!?':
+                confidence = 0.0
+                break
+        return found, confidence
+
+    #returns (label, confidence) from the lexicon words in text
+    def score_sentiment(self, text):
+        positive = negative = 0
+        # words left in the scope of the last negation, and whether the clause
+        # has one: a sentiment word past its scope could still be negated
+        negated = 0
+        clause_negated = unsure = False
+        for word in WORD_OR_STOP.findall(text.lower()):
+            if not word[0].isalpha():
+                negated = 0
+                clause_negated = False
+                continue
+            if word in NEGATIONS:
+                negated = NEGATION_SCOPE
+                clause_negated = True
+                continue
+            label = self.lexicon.get(word)
+            if label is not None:
+                if clause_negated and not negated:
+                    unsure = True
+                if negated:
+                    label = 'NEGATIVE' if label == 'POSITIVE' else 'POSITIVE'
+                if label == 'POSITIVE':
+                    positive += 1
+                elif label == 'NEGATIVE':
+                    negative += 1
+            if negated:
+                negated -= 1
+        if positive == negative:
+            return 'NEUTRAL', 0.0 if positive else 0.5
+        label = 'POSITIVE' if positive > negative else 'NEGATIVE'
+        confidence = abs(positive - negative) / float(positive + negative)
+        return label, confidence / 2 if unsure else confidence
+
+    def detect_entities(self, text):
+        return self.score_entities(text)[0]
+
+    def detect_sentiment(self, text):
+        return self.score_sentiment(text)[0]
+
+    def batch_detect_entities(self, texts):
+        return [self.detect_entities(text) for text in texts]
+
+    def batch_detect_sentiment(self, texts):
+        return [self.detect_sentiment(text) for text in texts]
+
+
+class FallbackDetector:
+    # local must have score_entities/score_sentiment, remote is any detector
+    def __init__(self, local, remote, threshold=0.6):
+        self.local = local
+        self.remote = remote
+        self.threshold = threshold
+
+    def detect_entities(self, text):
+        entities, confidence = self.local.score_entities(text)
+        if confidence < self.threshold:
+            return self.remote.detect_entities(text)
+        return entities
+
+    def detect_sentiment(self, text):
+        label, confidence = self.local.score_sentiment(text)
+        if confidence < self.threshold:
+            return self.remote.detect_sentiment(text)
+        return label
+
+    def batch_detect_entities(self, texts):
+        return self._batch(self.local.score_entities, self.remote.batch_detect_entities, texts)
+
+    def batch_detect_sentiment(self, texts):
+        return self._batch(self.local.score_sentiment, self.remote.batch_detect_sentiment, texts)
+
+    #only the texts the local detector is unsure about go to the remote batch call
+    def _batch(self, score, remote, texts):
+        results = []
+        unsure = []
+        for position, text in enumerate(texts):
+            result, confidence = score(text)
+            results.append(result)
+            if confidence < self.threshold:
+                unsure.append(position)
+        if unsure:
+            for position, result in zip(unsure, remote([texts[i] for i in unsure])):
+                if result is not None:
+                    results[position] = result
+        return results
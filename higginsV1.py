@@ -3,22 +3,22 @@
 ## Lambda Integration
 ## Custom Scripts
 
-import boto3
 import os
 from dotenv import load_dotenv
 import sys
 import json
 import logging
 import random
-import re
 from collections import namedtuple
 from pathlib import Path
+from matcher import DecompMatcher
+from normalizer import Normalizer
 import time
 from pprint import pprint
+import aws
 
 #load environment variables if you are using lambda functions locally
 load_dotenv()
-lambda_client = boto3.client(service_name='lambda')
 
 # Fix Python2/Python3 incompatibility
 try: input = raw_input
@@ -40,6 +40,7 @@ class Decomp:
         self.save = save
         self.reasmbs = reasmbs
         self.next_reasmb_index = 0
+        self.matcher = None
 
 
 class Higgins:
@@ -84,7 +85,7 @@ class Higgins:
                     self.posts[parts[0]] = parts[1:]
                 elif tag == 'synon':
                     parts = content.split(' ')
-                    self.synons[parts[0]] = parts
+                    self.synons[parts[0]] = frozenset(part.lower() for part in parts if part)
                 elif tag == 'key':
                     parts = content.split(' ')
                     word = parts[0]
@@ -112,37 +113,17 @@ class Higgins:
             if item.is_file():
                 print(item.name)
                 self.loadfile('scripts/'+item.name)
+        self.compile()
 
-    def _match_decomp_r(self, parts, words, results):
-        if not parts and not words:
-            return True
-        if not parts or (not words and parts != ['*']):
-            return False
-        if parts[0] == '*':
-            for index in range(len(words), -1, -1):
-                results.append(words[:index])
-                if self._match_decomp_r(parts[1:], words[index:], results):
-                    return True
-                results.pop()
-            return False
-        elif parts[0].startswith('@'):
-            root = parts[0][1:]
-            if not root in self.synons:
-                raise ValueError("Unknown synonym root {}".format(root))
-            if not words[0].lower() in self.synons[root]:
-                return False
-            results.append([words[0]])
-            return self._match_decomp_r(parts[1:], words[1:], results)
-        elif parts[0].lower() != words[0].lower():
-            return False
-        else:
-            return self._match_decomp_r(parts[1:], words[1:], results)
-
-    def _match_decomp(self, parts, words):
-        results = []
-        if self._match_decomp_r(parts, words, results):
-            return results
-        return None
+    #compiles every decomp pattern once all script files are loaded
+    def compile(self):
+        for key in self.keys.values():
+            for decomp in key.decomps:
+                decomp.matcher = DecompMatcher(decomp.parts, self.synons)
+        self.normalizer = Normalizer(self.pres, self.posts)
+
+    def _match_decomp(self, decomp, words, lowered):
+        return decomp.matcher.match(words, lowered)
 
     def _next_reasmb(self, decomp):
         index = decomp.next_reasmb_index
@@ -168,25 +149,15 @@ class Higgins:
                 output.append(reword)
         return output
 
-    def _sub(self, words, sub):
-        output = []
-        for word in words:
-            word_lower = word.lower()
-            if word_lower in sub:
-                output.extend(sub[word_lower])
-            else:
-                output.append(word)
-        return output
-
-    def _match_key(self, words, key):
+    def _match_key(self, words, lowered, key):
         for decomp in key.decomps:
-            results = self._match_decomp(decomp.parts, words)
+            results = self._match_decomp(decomp, words, lowered)
             if results is None:
                 log.debug('Decomp did not match: %s', decomp.parts)
                 continue
             log.debug('Decomp matched: %s', decomp.parts)
             log.debug('Decomp results: %s', results)
-            results = [self._sub(words, self.posts) for words in results]
+            results = [self.normalizer.post(group) for group in results]
             log.debug('Decomp results after posts: %s', results)
             reasmb = self._next_reasmb(decomp)
             log.debug('Using reassembly: %s', reasmb)
@@ -196,7 +167,7 @@ class Higgins:
                 if not goto_key in self.keys:
                     raise ValueError("Invalid goto key {}".format(goto_key))
                 log.debug('Goto key: %s', goto_key)
-                return self._match_key(words, self.keys[goto_key])
+                return self._match_key(words, lowered, self.keys[goto_key])
             elif reasmb[0] == 'lambda':
                 print("let's run a lambda!")
                 lambda_name = reasmb[1]
@@ -221,20 +192,12 @@ class Higgins:
         # phrases = re.split('[.,?;]', text)
         # print(phrases)
 
-        text = re.sub(r'\s*\.+\s*', ' . ', text)
-        text = re.sub(r'\s*,+\s*', ' , ', text)
-        text = re.sub(r'\s*\.+\s*', ' ? ', text)
-        text = re.sub(r'\s*;+\s*', ' ; ', text)
-        log.debug('After punctuation cleanup: %s', text)
-
-        words = [w for w in text.split(' ') if w]
-        log.debug('Input: %s', words)
-
-        words = self._sub(words, self.pres)
-        log.debug('After pre-substitution: %s', words)
+        # punctuation cleanup and pre-substitution in one pass
+        words, lowered = self.normalizer.tokenize(text)
+        log.debug('Input after pre-substitution: %s', words)
 
         #keys are turned lowercase here, which may be a problem for entity recognition
-        keys = [self.keys[w.lower()] for w in words if w.lower() in self.keys]
+        keys = [self.keys[w] for w in lowered if w in self.keys]
         keys = sorted(keys, key=lambda k: -k.weight)
         log.debug('Sorted keys: %s', [(k.word, k.weight) for k in keys])
 
@@ -243,7 +206,7 @@ class Higgins:
         for key in keys:
             log.debug('key:')
             # pprint(key.__dict__)
-            output = self._match_key(words, key)
+            output = self._match_key(words, lowered, key)
             if output:
                 last_key = key
                 log.debug('Output from key: %s', output)
@@ -268,7 +231,7 @@ class Higgins:
 
     def invoke_lambda(self,l):
         arn = os.environ.get(l)
-        response = lambda_client.invoke(
+        response = aws.client('lambda').invoke(
             FunctionName=str(arn),
             InvocationType="RequestResponse"
         )
@@ -5,15 +5,29 @@
 ## Lambda Integration
 ## Custom Scripts
 
-import boto3
 import os
 import sys
-import json
 import logging
 import random
-import re
+import uuid
 from collections import namedtuple
 from pathlib import Path
+from matcher import DecompMatcher
+from keyindex import KeyIndex
+from normalizer import Normalizer, split_clauses
+from scriptparser import parse_chunks, parse_file
+from script import SCRIPT_TABLES, ScriptError, compile_reassemblies, file_digest, read_bundle, write_bundle
+from s3store import S3Store, ScriptCache
+from reloader import Reloader
+from sessions import Session, SessionStore, MemoryBackend, SqliteBackend
+from comprehend import CachedComprehend, ResultCache
+from detectors import LocalDetector, FallbackDetector
+from actions import ActionExecutor, LambdaInvoker, LocalInvoker, parse_action
+import instrument
+from instrument import perf_counter
+import memory
+import aws
+from concurrent.futures import ThreadPoolExecutor
 import time
 from pprint import pprint
 
@@ -28,32 +42,105 @@ log.propagate = False
 
 #CONFIG
 #load environment variables
+#aws clients are created the first time a feature uses them, see aws.py
 
 bucket = os.environ.get('bucket_name')
 load_s3 = True
-s3_client = boto3.resource('s3')
+
+#downloaded scripts are cached by etag here, and fetched this many at a time
+cache_dir = os.environ.get('script_cache', '/tmp/higgins-scripts')
+fetch_workers = 8
+
+#fraction of turns timed and counted, see instrument.py
+instrument.sample_rate = float(os.environ.get('trace_sample_rate', 0))
+
+#precompiled script bundle, see compile_bundle
+bundle_path = os.environ.get('bundle_path', 'higgins.bundle')
+
+#seconds between checks for changed scripts, 0 turns reloading off
+reload_interval = float(os.environ.get('reload_interval', 60))
+
+#conversation state, kept in memory unless session_db names a sqlite file
+session_db = os.environ.get('session_db')
+session_capacity = 10000
+session_ttl = 1800
+#saves between eviction sweeps of the sqlite store, each sweep scans the table
+session_evict_every = 1000
+#replies and entities a session remembers, and for how many seconds, see memory.py
+memory.stm_capacity = 20
+memory.stm_ttl = 3600
+memory.mtm_capacity = 50
+memory.mtm_ttl = 24 * 3600
 
 #enable lambda functions
-lambda_client = boto3.client(service_name='lambda')
+#seconds an action is waited for before its fallback reply is used,
+#unless its lambda: line sets a timeout
+action_timeout = 3.0
+action_workers = 8
+#one client for every action so its connections are reused between turns, with
+#a connection per action worker and a read timeout that bounds abandoned calls
+def lambda_client():
+    return aws.client('lambda', config=aws.config(
+        max_pool_connections=action_workers, connect_timeout=1, read_timeout=10,
+        retries={'max_attempts': 2, 'mode': 'standard'}))
+
+#where actions run: 'lambda', or 'local' for the python callables in
+#local_actions, {action name: callable(payload) -> body}, offline and in tests
+action_invoker = os.environ.get('action_invoker', 'lambda')
+local_actions = {}
+
+def make_invoker():
+    if action_invoker == 'local':
+        return LocalInvoker(local_actions)
+    return LambdaInvoker(connect=lambda_client)
+
+actions = ActionExecutor(make_invoker(), workers=action_workers)
+
+#swaps the invoker every action runs through, e.g. for a LocalInvoker
+def use_invoker(invoker):
+    actions.invoker = invoker
 
 #advanced detection settings
 detect_entities_enabled = True
 detect_sentiment_enabled = True
-comprehend_client = boto3.client(service_name='comprehend', region_name='us-east-1')
-
-class Key:
-    def __init__(self, word, weight, decomps):
-        self.word = word
-        self.weight = weight
-        self.decomps = decomps
-
-
-class Decomp:
-    def __init__(self, parts, save, reasmbs):
-        self.parts = parts
-        self.save = save
-        self.reasmbs = reasmbs
-        self.next_reasmb_index = 0
+def comprehend_client():
+    return aws.client('comprehend', region_name='us-east-1')
+#repeated texts are answered from a cache, persisted when comprehend_cache names a directory
+comprehend = CachedComprehend(capacity=4096, ttl=3600, cache_dir=os.environ.get('comprehend_cache'),
+                              connect=comprehend_client)
+
+#where entities and sentiment come from: 'comprehend', 'local' (the entity: and
+#sentiment: script lines), or 'fallback' (local, comprehend when local is unsure)
+detector_mode = os.environ.get('detector', 'comprehend')
+detector_threshold = 0.6
+
+#how decomps see a multi-sentence input, split into clauses at . , ; and after ? or !
+#'off': the whole input, as before
+#'first': the first key that answers, matched against only the clauses it is in
+#'each': a reply for every clause a key answers, joined
+phrase_matching = os.environ.get('phrase_matching', 'off')
+
+#normalized inputs remembered with the stateless decomp that answered them, so
+#a repeated input skips key lookup and matching, see Higgins.memo. 0 turns it off
+memo_capacity = 2048
+
+#detection requests for a turn run on these pools while the input is matched
+#prefetch_sentiment also starts the sentiment request up front, which costs a
+#request on turns a key answers but takes it off the fallback path
+prefetch_sentiment = True
+
+#entities and sentiment have a pool each, with a thread per turn answered at
+#once, so no turn's entity request waits behind another's prefetched
+#sentiment. server.py sizes them to its --workers
+def detection_pools(turns):
+    global entity_pool, sentiment_pool
+    entity_pool = ThreadPoolExecutor(max_workers=turns)
+    sentiment_pool = ThreadPoolExecutor(max_workers=turns)
+
+detection_pools(8)
+
+#threads used by respond_many
+batch_workers = 8
 
 class Higgins:
     def __init__(self):
@@ -62,345 +149,414 @@ class Higgins:
         self.follows = []
         self.quits = []
         self.lambdas = []
+        self.actions = {}
         self.pres = {}
         self.posts = {}
         self.synons = {}
+        self.gazetteer = []
+        self.lexicon = {}
         self.keys = {}
-        self.stm = []
-        self.mtm = {}
-        self.last_key = None
+        self.index = None
+        self.local = None
+        self.normalizer = None
+        self.xnone = None
+        #conversation state for respond() calls that don't pass a session
+        self.session = Session('local')
+        #{script name: digest or etag} of the loaded scripts
+        self.sources = {}
+        #{input words: (key, decomp, captures)} for inputs a stateless decomp
+        #answered, per engine so a reload starts it empty
+        self.memo = ResultCache(capacity=memo_capacity, ttl=float('inf'))
         self.simple = False
+        #typing delay of a reply in ms: minDelay plus delay per character, up
+        #to maxDelay. Scripts set them with delay: lines
         self.minDelay = 100
         self.maxDelay = 200
         self.delay = 10
 
     def loadfile(self, path):
-        key = None
-        decomp = None
-        with open(path) as file:
-            for line in file:
-                if not line.strip():
-                    continue
-                tag, content = [part.strip() for part in line.split(':')]
-                if tag == 'initial':
-                    self.initials.append(content)
-                elif tag == 'final':
-                    self.finals.append(content)
-                elif tag == 'follow':
-                    self.follows.append(content)
-                elif tag == 'lambda':
-                    self.lambdas.append(content)
-                elif tag == 'quit':
-                    self.quits.append(content)
-                elif tag == 'pre':
-                    parts = content.split(' ')
-                    self.pres[parts[0]] = parts[1:]
-                elif tag == 'post':
-                    parts = content.split(' ')
-                    self.posts[parts[0]] = parts[1:]
-                elif tag == 'synon':
-                    parts = content.split(' ')
-                    self.synons[parts[0]] = parts
-                elif tag == 'key':
-                    parts = content.split(' ')
-                    word = parts[0]
-                    weight = int(parts[1]) if len(parts) > 1 else 1
-                    key = Key(word, weight, [])
-                    self.keys[word] = key
-                elif tag == 'decomp':
-                    parts = content.split(' ')
-                    save = False
-                    if parts[0] == '$':
-                        save = True
-                        parts = parts[1:]
-                    decomp = Decomp(parts, save, [])
-                    key.decomps.append(decomp)
-                elif tag == 'reasmb':
-                    parts = content.split(' ')
-                    decomp.reasmbs.append(parts)
-
-    def loads3file(self, file):
-        key = None
-        decomp = None
-        for line in file.get()['Body']._raw_stream:
-            line = str(line.decode('ascii'))
-            if len(line.split(':')) == 2:
-                tag, content = [part.strip() for part in line.split(':')]
-                if tag == 'initial':
-                    self.initials.append(content)
-                elif tag == 'final':
-                    self.finals.append(content)
-                elif tag == 'follow':
-                    self.follows.append(content)
-                elif tag == 'lambda':
-                    self.lambdas.append(content)
-                elif tag == 'quit':
-                    self.quits.append(content)
-                elif tag == 'pre':
-                    parts = content.split(' ')
-                    self.pres[parts[0]] = parts[1:]
-                elif tag == 'post':
-                    parts = content.split(' ')
-                    self.posts[parts[0]] = parts[1:]
-                elif tag == 'synon':
-                    parts = content.split(' ')
-                    self.synons[parts[0]] = parts
-                elif tag == 'key':
-                    parts = content.split(' ')
-                    word = parts[0]
-                    weight = int(parts[1]) if len(parts) > 1 else 1
-                    key = Key(word, weight, [])
-                    self.keys[word] = key
-                elif tag == 'decomp':
-                    parts = content.split(' ')
-                    save = False
-                    if parts[0] == '$':
-                        save = True
-                        parts = parts[1:]
-                    decomp = Decomp(parts, save, [])
-                    key.decomps.append(decomp)
-                elif tag == 'reasmb':
-                    parts = content.split(' ')
-                    decomp.reasmbs.append(parts)
+        parse_file(self, path)
+
+    #parses the raw bytes of a script downloaded from s3
+    def loads3file(self, data, name='<s3>'):
+        parse_chunks(self, [data], name)
 
     #loads all scripts in local scripts folder
     def load_local(self):
-        print('loading local')
-        corepath = Path('scripts/core/')
-        files_in_corepath = corepath.iterdir()
-        for item in files_in_corepath:
-            if item.is_file():
-                self.loadfile(item)
-        addonpath = Path('scripts/addons/')
-        files_in_addonpath = addonpath.iterdir()
-        for item in files_in_addonpath:
-            if item.is_file():
-                self.loadfile(item)
-
-    #loads s3 scripts
-    def load_s3(self):
-        print('loading s3')
-        obj = s3_client.Object(bucket, 'script.txt')
-        self.loads3file(obj)
-        my_bucket = s3_client.Bucket(bucket)
-        for object_summary in my_bucket.objects.filter(Prefix="scripts/core/"):
-            print(object_summary.key)
-            obj = s3_client.Object(bucket, object_summary.key)
-            print(obj)
-            self.loads3file(obj)
-        
-
-    def _match_decomp_r(self, parts, words, results):
-        if not parts and not words:
-            return True
-        if not parts or (not words and parts != ['*']):
-            return False
-        if parts[0] == '*':
-            for index in range(len(words), -1, -1):
-                results.append(words[:index])
-                if self._match_decomp_r(parts[1:], words[index:], results):
-                    return True
-                results.pop()
-            return False
-        elif parts[0].startswith('@'):
-            root = parts[0][1:]
-            if not root in self.synons:
-                raise ValueError("Unknown synonym root {}".format(root))
-            if not words[0].lower() in self.synons[root]:
-                return False
-            results.append([words[0]])
-            return self._match_decomp_r(parts[1:], words[1:], results)
-        elif parts[0].lower() != words[0].lower():
+        log.info('Loading local scripts')
+        files = local_files()
+        sources = dict((item.as_posix(), file_digest(item)) for item in files)
+        self.sources = sources
+        if self.load_bundle(bundle_path, sources):
+            return sources
+        for item in files:
+            self.loadfile(item)
+        self.compile()
+        return sources
+
+    #loads s3 scripts, store defaults to the bucket and can be a LocalStore
+    def load_s3(self, store=None):
+        log.info('Loading s3 scripts from %s', bucket)
+        if store is None:
+            store = S3Store(aws.client('s3'), bucket)
+        cache = ScriptCache(cache_dir)
+        with ThreadPoolExecutor(max_workers=fetch_workers) as pool:
+            listing = pool.submit(store.list, 'scripts/core/')
+            script = pool.submit(cache.fetch, store, 'script.txt')
+            listed = listing.result()
+            files = [script.result()]
+            # listed etags let a fresh bundle skip every other download
+            sources = dict((key, etag) for key, etag in listed)
+            sources[files[0][0]] = files[0][1]
+            self.sources = sources
+            if self.load_bundle(bundle_path, sources):
+                cache.save()
+                return sources
+            files.extend(pool.map(lambda item: cache.fetch(store, *item), listed))
+        cache.save()
+        for key, etag, data in files:
+            log.debug('Parsing %s', key)
+            self.loads3file(data, key)
+        self.compile()
+        return sources
+
+    #loads a precompiled bundle, returns False if it is missing or stale
+    def load_bundle(self, path, sources):
+        tables = read_bundle(path, sources)
+        if tables is None:
             return False
-        else:
-            return self._match_decomp_r(parts[1:], words[1:], results)
-
-    def _match_decomp(self, parts, words):
-        results = []
-        if self._match_decomp_r(parts, words, results):
-            return results
-        return None
-
-    def _next_reasmb(self, decomp):
-        index = decomp.next_reasmb_index
-        result = decomp.reasmbs[index % len(decomp.reasmbs)]
-        decomp.next_reasmb_index = index + 1
+        for name in SCRIPT_TABLES:
+            setattr(self, name, tables[name])
+        self.resolve_actions()
+        return True
+
+    def save_bundle(self, path, sources):
+        tables = dict((name, getattr(self, name)) for name in SCRIPT_TABLES)
+        write_bundle(path, tables, sources)
+
+    #compiles every decomp pattern and the key index once all script files are
+    #loaded. A broken script raises ScriptError here rather than mid-conversation
+    def compile(self):
+        if 'xnone' not in self.keys:
+            raise ScriptError('Invalid script: no xnone key')
+        compile_reassemblies(self.keys, self.synons)
+        self.xnone = self.keys['xnone'].decomps[0]
+        for key in self.keys.values():
+            for position, decomp in enumerate(key.decomps):
+                decomp.id = (key.word, position)
+                decomp.matcher = DecompMatcher(decomp.parts, self.synons)
+        self.index = KeyIndex(self.keys)
+        self.normalizer = Normalizer(self.pres, self.posts)
+        self.local = LocalDetector(self.gazetteer, self.lexicon)
+        self.resolve_actions()
+
+    #resolves every lambda action the scripts use to its target once, options
+    #come from lambda: lines. Not bundled, targets depend on the environment
+    def resolve_actions(self):
+        actions = {}
+        for content in self.lambdas:
+            action = parse_action(content, action_timeout)
+            actions[action.name] = action
+        for key in self.keys.values():
+            for decomp in key.decomps:
+                for template in decomp.templates:
+                    if template.action == 'lambda' and template.target not in actions:
+                        actions[template.target] = parse_action(template.target, action_timeout)
+        self.actions = actions
+
+    def _match_decomp(self, decomp, words, lowered):
+        return decomp.matcher.match(words, lowered)
+
+    #reassemblies rotate per session, the decomp itself is shared
+    #returns the Reassembly template to answer with
+    def _next_reasmb(self, decomp, session):
+        index = session.rotations.get(decomp.id, 0)
+        result = decomp.templates[index % len(decomp.templates)]
+        session.rotations[decomp.id] = index + 1
         return result
 
-    def _reassemble(self, reasmb, results):
-        output = []
-        for reword in reasmb:
-            if not reword:
-                continue
-            if reword[0] == '(' and reword[-1] == ')':
-                index = int(reword[1:-1])
-                if index < 1 or index > len(results):
-                    raise ValueError("Invalid result index {}".format(index))
-                insert = results[index - 1]
-                for punct in [',', '.', ';']:
-                    if punct in insert:
-                        insert = insert[:insert.index(punct)]
-                output.extend(insert)
-            else:
-                output.append(reword)
-        return output
-
-    def _sub(self, words, sub):
-        output = []
-        for word in words:
-            word_lower = word.lower()
-            if word_lower in sub:
-                output.extend(sub[word_lower])
-            else:
-                output.append(word)
-        return output
-
-    def _match_key(self, words, key):
-        print(key)
-        print(words)
+    #lowered is words in lowercase, from Normalizer.tokenize
+    #memo, when given, gets (key, decomp, captures) of the first decomp that
+    #matches appended, or None when that decomp isn't stateless
+    def _match_key(self, words, lowered, key, session, memo=None):
+        trace = instrument.current()
         for decomp in key.decomps:
-            print(decomp.parts)
-            results = self._match_decomp(decomp.parts, words)
-            print(results)
+            if trace:
+                started = perf_counter()
+            results = self._match_decomp(decomp, words, lowered)
+            if trace:
+                trace.stage('decomp_match', started, decomp=decomp.parts, matched=results is not None)
             if results is None:
                 log.debug('Decomp did not match: %s', decomp.parts)
                 continue
             log.debug('Decomp matched: %s', decomp.parts)
             log.debug('Decomp results: %s', results)
-            results = [self._sub(words, self.posts) for words in results]
+            results = [self.normalizer.post(group) for group in results]
             log.debug('Decomp results after posts: %s', results)
-            reasmb = self._next_reasmb(decomp)
-            log.debug('Using reassembly: %s', reasmb)
+            if memo is not None and not memo:
+                memo.append((key, decomp, results) if decomp.stateless else None)
+            reasmb = self._next_reasmb(decomp, session)
+            log.debug('Using reassembly: %s %s', reasmb.action, reasmb.parts)
+            if trace:
+                trace.count('decomp:{}/{}'.format(*decomp.id))
 
             # other keys can be added here!
-            if reasmb[0] == 'goto':
-                goto_key = reasmb[1]
-                if not goto_key in self.keys:
-                    raise ValueError("Invalid goto key {}".format(goto_key))
-                log.debug('Goto key: %s', goto_key)
-                return self._match_key(words, self.keys[goto_key])
-            elif reasmb[0] == 'lambda':
-                print("let's run a lambda!")
-                lambda_name = reasmb[1]
-                result = self.invoke_lambda(lambda_name)
-                return result
+            if reasmb.action == 'goto':
+                log.debug('Goto key: %s', reasmb.target.word)
+                return self._match_key(words, lowered, reasmb.target, session, memo)
+            elif reasmb.action == 'lambda':
+                lambda_name = reasmb.target
+                log.debug('Lambda action: %s', lambda_name)
+                if trace:
+                    started = perf_counter()
+                result = self.invoke_lambda(lambda_name, words, session)
+                if trace:
+                    trace.stage('lambda_invoke', started, name=lambda_name, answered=result is not None)
+                if result is not None:
+                    return [result]
+                # no answer in time, or an event action: the rest of the
+                # reassembly is the fallback reply, else xnone answers
+                if reasmb.parts:
+                    output = reasmb.render(results, session.mtm)
+                    if output is not None:
+                        return output
+                return self._next_reasmb(self.xnone, session).render((), session.mtm)
             # keys that link to custom scripts/actions can be added down here!
-            elif reasmb[0] == 'confirm':
-                print("we're going to need some confirmation here")
-                print("but what are we confirming?")
-            output = self._reassemble(reasmb, results)
+            # a confirm reassembly is answered like a plain reply
+            if trace:
+                started = perf_counter()
+            output = reasmb.render(results, session.mtm)
+            if trace:
+                trace.stage('reassembly', started)
+            if output is None:
+                log.debug('Nothing in memory for %s', reasmb.parts)
+                continue
             if decomp.save:
-                self.stm.append(output)
+                session.stm.add(output)
                 log.debug('Saved to memory: %s', output)
                 continue
             return output
         return None
     
-    def invoke_lambda(self,l):
-        arn = os.environ.get(l)
-        response = lambda_client.invoke(
-            FunctionName=str(arn),
-            InvocationType="RequestResponse"
-        )
-        payload = json.loads(response['Payload'].read())
-        return payload['body']
-
-    def entity_detection(self,text):
-        entities = comprehend_client.detect_entities(Text=text, LanguageCode='en')
-        for e in entities['Entities']:
-            print(e)
-            output = None
-            
-            if e['Text'].lower() in self.keys:
-                key = self.keys[e['Text'].lower()]
-                words = [w for w in text.split(' ') if w]
-                words = self._sub(words, self.pres)
-                output = self._match_key(words, key)
-                self.stm.append(output)
+    #candidates are (key, words, lowered) in the order they are tried
+    #returns the output of the first that answers, or None
+    def _first_answer(self, candidates, session, memo=None):
+        trace = instrument.current()
+        for key, words, lowered in candidates:
+            output = self._match_key(words, lowered, key, session, memo)
+            if output:
+                session.last_key = key.word
+                log.debug('Output from key: %s', output)
+                if trace:
+                    trace.count('key:' + key.word)
                 return output
-            elif e['Type'].lower() in self.keys:
-                key = self.keys[e['Type'].lower()]
-                words = [w for w in text.split(' ') if w]
-                words = self._sub(words, self.pres)
-                if e['Text'] in self.mtm:
-                    print('in mtm')
-                    print(e['Text'])
-                else:
-                    self.mtm[e['Text']] = []
-                    self.mtm[e['Text']].append(output)
-                    print(self.mtm)
-                output = self._match_key(words, key)
-                self.stm.append(output)
+        return None
+
+    #found is from KeyIndex.find_clauses, decomps only see the clauses a key is in
+    def _answer_clauses(self, clauses, found, session, memo=None):
+        if phrase_matching == 'each':
+            by_clause = [[] for _ in clauses]
+            for key, numbers in found:
+                for number in numbers:
+                    by_clause[number].append(key)
+            output = []
+            for (words, lowered), keys in zip(clauses, by_clause):
+                answer = self._first_answer(((key, words, lowered) for key in keys), session)
+                if answer:
+                    output.extend(answer)
+            return output or None
+        return self._first_answer(((key,) + clauses[number] for key, numbers in found for number in numbers),
+                                  session, memo)
+
+    #returns the body the action answered with, or None to fall back
+    def invoke_lambda(self, name, words, session):
+        action = self.actions[name]
+        payload = {'action': name, 'text': ' '.join(words), 'session': session.id}
+        return actions.run(action, payload)
+
+    def detector(self):
+        if detector_mode == 'local':
+            return self.local
+        if detector_mode == 'fallback':
+            return FallbackDetector(self.local, comprehend, detector_threshold)
+        return comprehend
+
+    #entities can be passed in when they were already detected in a batch
+    #words and lowered are the normalized input, from Normalizer.tokenize
+    def entity_detection(self, text, words, lowered, session, entities=None):
+        if entities is None:
+            entities = self.detector().detect_entities(text)
+        for e in entities:
+            log.debug('Entity: %s', e)
+            session.mtm.remember(e['Text'], e['Type'])
+        for e in entities:
+            key = self.keys.get(e['Text'].lower()) or self.keys.get(e['Type'].lower())
+            if key is not None:
+                output = self._match_key(words, lowered, key, session)
+                session.stm.add(output)
                 return output
         return None
     
-    def sentiment_detection(self,text):
+    def sentiment_detection(self, text, words, lowered, session, sentiment=None):
         output = None
-        raw = comprehend_client.detect_sentiment(Text=text, LanguageCode='en')
-        s = raw['Sentiment']
+        if sentiment is None:
+            sentiment = self.detector().detect_sentiment(text)
+        s = sentiment
         if s.lower() in self.keys:
             key = self.keys[s.lower()]
-            words = [w for w in text.split(' ') if w]
-            words = self._sub(words, self.pres)
-            output = self._match_key(words, key)
+            output = self._match_key(words, lowered, key, session)
             return output
         return None
 
-    def respond(self, text):
+    #session holds the conversation state, defaults to the single local session
+    #entities and sentiment are comprehend results detected ahead of time
+    def respond(self, text, session=None, entities=None, sentiment=None):
+        if session is None:
+            session = self.session
         output = None
-
-        if detect_entities_enabled:
-            entity_output = self.entity_detection(text)
-            if entity_output is not None:
-                return " ".join(entity_output)
-
-        if text.lower() in self.quits:
-            return None
-
-        phrases = re.split('[.,?;]', text)
-        # print(phrases)
-
-        text = re.sub(r'\s*\.+\s*', ' . ', text)
-        text = re.sub(r'\s*,+\s*', ' , ', text)
-        text = re.sub(r'\s*\.+\s*', ' ? ', text)
-        text = re.sub(r'\s*;+\s*', ' ; ', text)
-        log.debug('After punctuation cleanup: %s', text)
-
-        words = [w for w in text.split(' ') if w]
-        log.debug('Input: %s', words)
-
-        words = self._sub(words, self.pres)
-        log.debug('After pre-substitution: %s', words)
-
-        keys = [self.keys[w.lower()] for w in words if w.lower() in self.keys]
-        keys = sorted(keys, key=lambda k: -k.weight)
-        log.debug('Sorted keys: %s', [(k.word, k.weight) for k in keys])
- 
-        for key in keys:
-            log.debug('key:')
-            # pprint(key.__dict__)
-            output = self._match_key(words, key)
-            if output:
-                last_key = key
-                log.debug('Output from key: %s', output)
-                break
-        if not output:
-            #if no output, pull default from stm
-            if self.stm:
-                index = random.randrange(len(self.stm))
-                output = self.stm.pop(index)
-                log.debug('Output from memory: %s', output)
+        trace = instrument.begin()
+
+        # detection requests run in the background while the input is matched
+        # locally; results are still used in the usual order:
+        # entities, keys, memory, sentiment
+        detector = self.detector()
+        pending_entities = pending_sentiment = None
+        if detect_entities_enabled and entities is None:
+            pending_entities = entity_pool.submit(detector.detect_entities, text)
+
+        try:
+            if trace:
+                started = perf_counter()
+            if detect_sentiment_enabled and sentiment is None and prefetch_sentiment:
+                pending_sentiment = sentiment_pool.submit(detector.detect_sentiment, text)
+
+            # punctuation cleanup and pre-substitution in one pass
+            words, lowered = self.normalizer.tokenize(text)
+            log.debug('Input after pre-substitution: %s', words)
+            if trace:
+                trace.stage('normalize', started, words=len(words))
+                started = perf_counter()
+
+            # an input answered by a stateless decomp before needs no key lookup
+            memo = hit = None
+            if memo_capacity and phrase_matching != 'each':
+                memo = []
+                hit = self.memo.get(tuple(words))
+            if hit is not None:
+                if trace:
+                    trace.stage('memo', started)
+            elif phrase_matching == 'off':
+                keys = self.index.find(lowered)
             else:
-                if detect_sentiment_enabled:
-                    sentiment_response = self.sentiment_detection(text)
-                    if sentiment_response is not None:
-                        output = sentiment_response
+                # the input is cut into clauses once and each key found with its clauses
+                clauses, clause_of = split_clauses(words, lowered)
+                found = self.index.find_clauses(lowered, clause_of)
+                keys = [key for key, numbers in found]
+            if hit is None:
+                log.debug('Sorted keys: %s', [(k.word, k.weight) for k in keys])
+                if trace:
+                    trace.stage('key_lookup', started, keys=[k.word for k in keys])
+
+            if detect_entities_enabled:
+                if pending_entities is not None:
+                    if trace:
+                        started = perf_counter()
+                    entities = pending_entities.result()
+                    if trace:
+                        trace.stage('comprehend', started, call='entities')
+                entity_output = self.entity_detection(text, words, lowered, session, entities)
+                if entity_output is not None:
+                    if trace:
+                        trace.count('output:entity')
+                    return " ".join(entity_output)
+
+            if text.lower() in self.quits:
+                return None
+
+            if hit is not None:
+                # the reassembly still rotates per session
+                key, decomp, results = hit
+                output = self._next_reasmb(decomp, session).render(results)
+                session.last_key = key.word
+                log.debug('Output from memo of key: %s', key.word)
+                if trace:
+                    trace.count('key:' + key.word)
+                    trace.count('output:memo')
+            elif phrase_matching == 'off':
+                output = self._first_answer(((key, words, lowered) for key in keys), session, memo)
+            else:
+                output = self._answer_clauses(clauses, found, session, memo)
+            if output and memo:
+                if memo[0] is not None:
+                    self.memo.put(tuple(words), memo[0])
+            if not output:
+                #if no output, pull default from stm
+                output = session.stm.recall()
+                if output is not None:
+                    log.debug('Output from memory: %s', output)
+                    if trace:
+                        trace.count('output:memory')
                 else:
-                    # fallback output
-                    output = self._next_reasmb(self.keys['xnone'].decomps[0])
-                    log.debug('Output from xnone: %s', output)
-
-        return " ".join(output)
+                    if detect_sentiment_enabled:
+                        if pending_sentiment is not None:
+                            if trace:
+                                started = perf_counter()
+                            sentiment = pending_sentiment.result()
+                            if trace:
+                                trace.stage('comprehend', started, call='sentiment')
+                        output = self.sentiment_detection(text, words, lowered, session, sentiment)
+                        if output is not None and trace:
+                            trace.count('output:sentiment')
+                    if output is None:
+                        # fallback output
+                        output = self._next_reasmb(self.xnone, session).render((), session.mtm)
+                        log.debug('Output from xnone: %s', output)
+                        if trace:
+                            trace.count('output:xnone')
+
+            return " ".join(output)
+        finally:
+            # requests whose answer is no longer needed are dropped if they
+            # haven't started; one already running finishes, and is ignored
+            for pending in (pending_entities, pending_sentiment):
+                if pending is not None:
+                    pending.cancel()
+            instrument.end(trace)
+
+    #answers many (session, text) turns and returns the outputs in input order
+    #each session's turns run in order, different sessions run concurrently
+    def respond_many(self, turns):
+        turns = list(turns)
+        texts = [text for session, text in turns]
+        groups = {}
+        for position, (session, text) in enumerate(turns):
+            groups.setdefault(id(session), []).append(position)
+        outputs = [None] * len(turns)
+        with ThreadPoolExecutor(max_workers=batch_workers) as pool:
+            entities = [None] * len(turns)
+            sentiments = [None] * len(turns)
+            if detect_entities_enabled:
+                entities = pool.submit(self.detector().batch_detect_entities, texts)
+            if detect_sentiment_enabled:
+                sentiments = pool.submit(self.detector().batch_detect_sentiment, texts)
+            if detect_entities_enabled:
+                entities = entities.result()
+            if detect_sentiment_enabled:
+                sentiments = sentiments.result()
+
+            def run(positions):
+                for position in positions:
+                    session, text = turns[position]
+                    outputs[position] = self.respond(text, session, entities[position], sentiments[position])
+
+            list(pool.map(run, groups.values()))
+        return outputs
+
+    #milliseconds a person would take to type output, 0 when there is none
+    def typing_delay(self, output):
+        if not output:
+            return 0
+        return max(self.minDelay, min(self.maxDelay, self.minDelay + self.delay * len(output)))
 
     def initial(self):
         return random.choice(self.initials)
@@ -408,12 +564,17 @@ class Higgins:
     def final(self):
         return random.choice(self.finals)
 
-    def run(self):
+    def follow(self):
+        return random.choice(self.follows)
+
+    #engine returns the Higgins to answer with, so a reload can swap it mid-conversation
+    def run(self, engine=None):
         print(self.initial())
 
         while True:
             sent = input('> ')
-            output = self.respond(sent)
+            current = engine() if engine else self
+            output = current.respond(sent, self.session)
             if output is None:
                 break
 
@@ -421,26 +582,179 @@ class Higgins:
 
         print(self.final())
 
+#script files load_local reads, core before addons
+def local_files():
+    files = []
+    for path in [Path('scripts/core/'), Path('scripts/addons/')]:
+        files.extend(item for item in path.iterdir() if item.is_file())
+    return files
+
+def local_sources():
+    return dict((item.as_posix(), file_digest(item)) for item in local_files())
+
+#the etags load_s3 would load, without downloading anything
+def s3_sources():
+    store = S3Store(aws.client('s3'), bucket)
+    sources = dict(store.list('scripts/core/'))
+    sources['script.txt'] = store.etag('script.txt')
+    return sources
+
+def reload_local():
+    engine = Higgins()
+    engine.load_local()
+    return engine
+
+def reload_s3():
+    engine = Higgins()
+    engine.load_s3()
+    return engine
+
+#set up by init: the engine answering now, reloads replace it
+higgins = None
+sessions = None
+reloader = None
+
+def current():
+    return higgins
+
+#turns already running keep the engine they started with
+def install(engine):
+    global higgins
+    higgins = engine
+
+def session_backend():
+    if session_db:
+        return SqliteBackend(session_db)
+    return MemoryBackend()
+
+#also run in each forked worker, a sqlite connection can't be shared across a fork
+def open_sessions():
+    global sessions
+    backend = session_backend()
+    evict_every = session_evict_every if isinstance(backend, SqliteBackend) else 1
+    sessions = SessionStore(backend, session_capacity, session_ttl, evict_every)
+
+#loads the scripts from 's3' or 'local' and opens the sessions the handlers use
+def init(source='s3'):
+    global reloader
+    if source == 'local':
+        version, load = local_sources, reload_local
+    else:
+        version, load = s3_sources, reload_s3
+    install(load())
+    open_sessions()
+    #lambda freezes the container between invocations, so changes are checked
+    #for on requests and loaded in the background while the request is answered
+    reloader = Reloader(version, load, install, higgins.sources, reload_interval)
+
 #local only methods
 def main():
+    global higgins
     higgins = Higgins()
     higgins.load_local()
     # higgins.load_s3()
-    higgins.run()
+    if reload_interval:
+        Reloader(local_sources, reload_local, install, higgins.sources, reload_interval).watch()
+    higgins.run(current)
+
+#deploy step: python higginsV2.py compile [s3]
+#parses the local (or s3) scripts and writes them to bundle_path
+def compile_bundle(source):
+    higgins = Higgins()
+    if source == 's3':
+        sources = higgins.load_s3()
+    else:
+        sources = higgins.load_local()
+    higgins.save_bundle(bundle_path, sources)
+    print('wrote {} ({} scripts)'.format(bundle_path, len(sources)))
 
 if __name__ == '__main__':
+    from dotenv import load_dotenv
     load_dotenv()
     logging.basicConfig()
-    main()
-else:
-    higgins = Higgins()
-    higgins.load_s3()
-
+    if len(sys.argv) > 1 and sys.argv[1] == 'compile':
+        compile_bundle(sys.argv[2] if len(sys.argv) > 2 else 'local')
+    else:
+        main()
+elif os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    # in lambda the scripts load during the init phase, imported anywhere
+    # else (server.py, bench.py) nothing loads until init() is called
+    init('s3')
+
+
+#one turn of session_id's conversation, shared by lambda_handler and server.py
+#trace asks for a json trace of the turn, returned as 'trace'
+def converse(session_id, text, trace=False):
+    if higgins is None:
+        init('s3')
+    reloader.check()
+    if trace:
+        instrument.request_trace()
+    engine = higgins
+    session = sessions.get(session_id)
+    output = engine.respond(text, session)
+    sessions.save(session)
+    response = {
+        'statusCode': 200,
+        'body': output,
+        # front ends wait this many ms before showing the reply
+        'delay': engine.typing_delay(output)
+    }
+    if trace:
+        response['trace'] = instrument.last_trace()
+    return response
+
+#a prompt for a session that went quiet: a follow: line, or a final: line
+#once the server has given up waiting
+def follow_up(session_id, final=False):
+    if higgins is None:
+        init('s3')
+    engine = higgins
+    if final or not engine.follows:
+        output = engine.final() if engine.finals else None
+    else:
+        output = engine.follow()
+    return {
+        'statusCode': 200,
+        'body': output,
+        'delay': engine.typing_delay(output)
+    }
 
+#event is {'Payload': text, 'session': id}, or the text alone from older pages.
+#a caller without a session gets a new one, returned so it can carry on with
+#it, rather than sharing one with every other anonymous caller
 def lambda_handler(event, context):
-    # TODO implement
-    output = higgins.respond(event['Payload'])
+    if isinstance(event, str):
+        event = {'Payload': event}
+    if 'Batch' in event:
+        return batch_handler(event['Batch'])
+    session_id = str(event.get('session') or uuid.uuid4())
+    response = converse(session_id, event['Payload'], event.get('trace'))
+    response['session'] = session_id
+    return response
+
+#batch mode: event['Batch'] is a list of {'session': ..., 'text': ...} items
+#body is the outputs in order, sessions the session each was answered in, so
+#items sent without one can carry on in the session they were given
+def batch_handler(items):
+    if higgins is None:
+        init('s3')
+    reloader.check()
+    engine = higgins
+    active = {}
+    turns = []
+    session_ids = []
+    for item in items:
+        session_id = str(item.get('session') or uuid.uuid4())
+        if session_id not in active:
+            active[session_id] = sessions.get(session_id)
+        turns.append((active[session_id], item['text']))
+        session_ids.append(session_id)
+    outputs = engine.respond_many(turns)
+    for session in active.values():
+        sessions.save(session)
     return {
         'statusCode': 200,
-        'body': output
-    }
\ No newline at end of file
+        'body': outputs,
+        'sessions': session_ids
+    }
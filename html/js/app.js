@@ -6,9 +6,13 @@ AWS.config.credentials = new AWS.CognitoIdentityCredentials({
 });
 
 var lambda = null
-var interval = null
-const wait = 30
-var counter = 0
+//connection to server.py, used when config.js sets HIGGINS_SERVER
+var socket = null
+//kept so a reconnected socket carries on the same conversation
+//one conversation per tab, kept across reloads of the page
+var session = sessionStorage.getItem('higgins-session') ||
+    (window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now() + '-' + Math.random().toString(36).slice(2))
+sessionStorage.setItem('higgins-session', session)
 
 var params = {
     FunctionName : 'HigginsV2',
@@ -22,7 +26,6 @@ input.focus()
 
 
 document.body.addEventListener('keypress',(e)=>{
-    stopResponseTimer()
     if(e.keyCode === 13){
         console.log('ask')
         output.textContent = "";
@@ -31,15 +34,55 @@ document.body.addEventListener('keypress',(e)=>{
     }
 })
 
+//delay is the typing delay in ms from the lambda, server.py has already waited it
+showResponse = (body, delay) => {
+    setTimeout(()=>{
+        output.class = ""
+        output.textContent = body;
+        input.value = "";
+        output.className = ""
+        input.focus()
+    }, delay || 0)
+}
+
+//one long lived connection instead of a signed lambda invoke per message,
+//the server also pushes follow up prompts down it when the user goes quiet
+requestSocketResponse = (text) => {
+    if(!socket){
+        socket = new WebSocket(window.HIGGINS_SERVER)
+        socket.onmessage = (e) => {
+            const results = JSON.parse(e.data)
+            console.log(results)
+            session = results.session
+            if(results.follow){
+                //a prompt the user didn't ask for, leave what they are typing alone
+                output.textContent = results.body
+                return
+            }
+            showResponse(results.body)
+        }
+        socket.onclose = () => {
+            socket = null
+        }
+    }
+    const message = JSON.stringify({text: text ? text : input.value, session: session})
+    if(socket.readyState === WebSocket.OPEN){
+        socket.send(message)
+    } else {
+        socket.addEventListener('open', () => socket.send(message), {once: true})
+    }
+}
+
 requestResponse = (text) => {
+    if(window.HIGGINS_SERVER){
+        requestSocketResponse(text)
+        return
+    }
     if(!lambda){
         lambda = new AWS.Lambda({region: 'us-east-1', apiVersion: '2015-03-31'});
     }
-    params['Payload'] = text ? JSON.stringify(text) : JSON.stringify(input.value)
+    params['Payload'] = JSON.stringify({Payload: text ? text : input.value, session: session})
     console.log(params)
-    if(!interval){
-        //startResponseTimer()
-    }
     lambda.invoke(params, function(err, data) {
         if (err) {
             console.log(params)
@@ -47,33 +90,7 @@ requestResponse = (text) => {
             const results = JSON.parse(data.Payload);
             console.log(results)
             console.log(results.body)
-            setTimeout(()=>{
-                output.class = ""
-                output.textContent = results.body;
-                input.value = "";
-                output.className = ""
-                input.focus()
-            },7)
+            showResponse(results.body, results.delay)
         }
     });
 }
-
-startResponseTimer = () => {
-    interval = setTimeout(() => {
-        console.log(counter)
-        if(counter >= 0 && counter < 3){
-            counter +=1;
-            requestResponse("hello")
-        } else {
-            stopResponseTimer()
-            requestResponse("quit")
-        }
-    }, 1000);
-}
-//(15 * (counter+1)) * 1000
-stopResponseTimer = () => {
-    console.log("STOP")
-    clearInterval(interval)
-    counter = 0
-    interval = null
-}
@@ -0,0 +1,136 @@
+# INSTRUMENTATION
+# Per-stage timers and key/decomp counters for a sample of turns, and an
+# opt-in JSON trace of a single turn. Turns that are not sampled get no
+# trace, and every probe in the engine is behind an "if trace" check, so
+# with sample_rate at 0 the cost is a thread-local lookup per turn.
+#
+#   trace = instrument.begin()        # None unless sampled or requested
+#   ... trace.stage('normalize', started) ...
+#   instrument.end(trace)
+
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+log = logging.getLogger('higgins.trace')
+log.setLevel(logging.INFO)
+
+#fraction of turns timed and counted, from 0 (off) to 1 (every turn)
+sample_rate = 0.0
+#seconds between aggregate reports logged from sampled turns
+report_interval = 60
+
+perf_counter = time.perf_counter
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class Stats:
+    def __init__(self):
+        self.timers = {}
+        self.counters = Counter()
+        self.turns = 0
+        self.reported = time.time()
+
+    def time(self, stage, seconds):
+        timer = self.timers.get(stage)
+        if timer is None:
+            timer = self.timers[stage] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+
+    def snapshot(self):
+        timers = {}
+        for stage, (count, total, longest) in self.timers.items():
+            timers[stage] = {'count': count, 'total_ms': round(total * 1000, 3),
+                             'mean_ms': round(total * 1000 / count, 3),
+                             'max_ms': round(longest * 1000, 3)}
+        return {'turns': self.turns, 'timers': timers, 'counters': dict(self.counters)}
+
+
+stats = Stats()
+
+
+class Trace:
+    def __init__(self, detailed):
+        self.started = perf_counter()
+        # detailed traces keep every event for the json trace of the turn
+        self.events = [] if detailed else None
+        self.timings = []
+        self.counts = []
+
+    # records the time since started (a perf_counter value) against stage
+    def stage(self, stage, started, **detail):
+        elapsed = perf_counter() - started
+        self.timings.append((stage, elapsed))
+        if self.events is not None:
+            event = {'stage': stage, 'ms': round(elapsed * 1000, 3)}
+            event.update(detail)
+            self.events.append(event)
+
+    def count(self, name, **detail):
+        self.counts.append(name)
+        if self.events is not None:
+            event = {'count': name}
+            event.update(detail)
+            self.events.append(event)
+
+    def to_json(self):
+        return json.dumps({'ms': round((perf_counter() - self.started) * 1000, 3),
+                           'events': self.events})
+
+
+#asks for a detailed trace of the next turn on this thread
+def request_trace():
+    _local.requested = True
+
+
+#starts a trace for a turn if it is sampled or a trace was requested
+def begin():
+    detailed = getattr(_local, 'requested', False)
+    if not detailed and (not sample_rate or random.random() >= sample_rate):
+        _local.trace = None
+        return None
+    _local.requested = False
+    trace = Trace(detailed)
+    _local.trace = trace
+    return trace
+
+
+#the trace of the turn running on this thread, for probes deeper in the engine
+def current():
+    return getattr(_local, 'trace', None)
+
+
+def end(trace):
+    if trace is None:
+        return
+    _local.trace = None
+    trace.stage('turn', trace.started)
+    with _lock:
+        stats.turns += 1
+        for stage, seconds in trace.timings:
+            stats.time(stage, seconds)
+        stats.counters.update(trace.counts)
+        report = time.time() - stats.reported > report_interval
+        if report:
+            stats.reported = time.time()
+            snapshot = stats.snapshot()
+    if trace.events is not None:
+        _local.last = trace.to_json()
+        log.info('turn trace %s', _local.last)
+    if report:
+        log.info('stats %s', json.dumps(snapshot))
+
+
+#the json trace of the last requested turn on this thread
+def last_trace():
+    last = getattr(_local, 'last', None)
+    _local.last = None
+    return last
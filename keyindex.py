@@ -0,0 +1,57 @@
+# KEYWORD INDEX
+# Token trie over the script keys, built once at load time. A single pass
+# over the input finds every key (including multi-word keys), so the cost
+# of a turn depends on the input length rather than on the key table size.
+# find_clauses also says which clauses of the input each key is in.
+
+
+class KeyIndex:
+    def __init__(self, keys):
+        self.root = {}
+        for key in keys.values():
+            node = self.root
+            tokens = key.word.lower().split(' ')
+            for token in tokens:
+                node = node.setdefault(token, {})
+            # None marks the end of a key, tokens are never None
+            node[None] = (key, len(tokens))
+
+    #yields (start, (key, length)) for every key in lowered, in input order
+    def scan(self, lowered):
+        root = self.root
+        end = len(lowered)
+        for start, token in enumerate(lowered):
+            node = root.get(token)
+            pos = start + 1
+            while node is not None:
+                entry = node.get(None)
+                if entry is not None:
+                    yield start, entry
+                if pos == end:
+                    break
+                node = node.get(lowered[pos])
+                pos += 1
+
+    # lowered is the lowercased token list of the input
+    # returns matched keys by weight, then by first position in the input
+    def find(self, lowered):
+        found = {}
+        for start, (key, length) in self.scan(lowered):
+            if key.word not in found:
+                found[key.word] = (-key.weight, start, -length, key)
+        return [entry[3] for entry in sorted(found.values())]
+
+    # clause_of is the clause number of each token, from split_clauses
+    # returns [(key, clause numbers it appears in)], keys ordered as find
+    def find_clauses(self, lowered, clause_of):
+        found = {}
+        for start, (key, length) in self.scan(lowered):
+            clause = clause_of[start]
+            if clause is None:
+                continue
+            entry = found.get(key.word)
+            if entry is None:
+                found[key.word] = (-key.weight, start, -length, key, [clause])
+            elif entry[4][-1] != clause:
+                entry[4].append(clause)
+        return [(entry[3], entry[4]) for entry in sorted(found.values())]
@@ -0,0 +1,93 @@
+# DECOMP MATCHER
+# Compiles decomp patterns once at load time. Matching gives the same
+# capture groups as the old recursive backtracking matcher (greedy '*',
+# leftmost first), but remembers failed (part, word) positions so a
+# pattern with several wildcards is polynomial instead of exponential.
+# Literals are lowercased here and synonym groups are sets of lowercase
+# words, so matching only compares the input's precomputed lowercase tokens.
+
+WILDCARD = 0
+SYNON = 1
+LITERAL = 2
+
+
+class DecompMatcher:
+    # synons: {root: frozenset of lowercase words}
+    def __init__(self, parts, synons):
+        self.parts = parts
+        self.ops = []
+        self.literals = []
+        self.min_words = 0
+        for part in parts:
+            if part == '*':
+                self.ops.append((WILDCARD, None))
+                continue
+            self.min_words += 1
+            if part.startswith('@'):
+                root = part[1:]
+                # unknown roots only fail when the part is reached, as before
+                self.ops.append((SYNON, (root, synons.get(root))))
+            else:
+                literal = part.lower()
+                self.ops.append((LITERAL, literal))
+                self.literals.append(literal)
+
+    # words are the input tokens, lowered the same tokens lowercased
+    def match(self, words, lowered):
+        ops = self.ops
+        nops = len(ops)
+        nwords = len(words)
+        if nwords < self.min_words:
+            return None
+        for literal in self.literals:
+            if literal not in lowered:
+                return None
+
+        results = []
+        failed = set()
+
+        def step(i, j):
+            if i == nops:
+                return j == nwords
+            # with the input used up only a single trailing '*' may remain
+            if j == nwords and not (i == nops - 1 and ops[i][0] == WILDCARD):
+                return False
+            state = i * (nwords + 1) + j
+            if state in failed:
+                return False
+            kind, value = ops[i]
+            if kind == WILDCARD:
+                following = ops[i + 1] if i + 1 < nops else (WILDCARD, None)
+                if following[0] == LITERAL:
+                    # only split where the next literal can match
+                    literal = following[1]
+                    ends = [k for k in range(nwords - 1, j - 1, -1) if lowered[k] == literal]
+                elif following[0] == SYNON and following[1][1] is not None:
+                    # or where a word of the next synonym group is
+                    synon = following[1][1]
+                    ends = [k for k in range(nwords - 1, j - 1, -1) if lowered[k] in synon]
+                else:
+                    ends = range(nwords, j - 1, -1)
+                for k in ends:
+                    results.append(words[j:k])
+                    if step(i + 1, k):
+                        return True
+                    results.pop()
+            elif kind == SYNON:
+                root, synon = value
+                if synon is None:
+                    raise ValueError("Unknown synonym root {}".format(root))
+                if lowered[j] in synon:
+                    results.append([words[j]])
+                    if step(i + 1, j + 1):
+                        return True
+                    results.pop()
+            elif lowered[j] == value:
+                if step(i + 1, j + 1):
+                    return True
+            failed.add(state)
+            return False
+
+        if step(0, 0):
+            return results
+        return None
@@ -0,0 +1,113 @@
+# MEMORY
+# Bounded per-session memory, so a long conversation in a warm container
+# uses a predictable amount of it.
+# ShortTermMemory holds replies saved by '$' decomps, to be brought up
+# later when no key answers: a fixed size bag where saving, evicting and
+# recalling a random reply are all O(1), and replies expire after a ttl.
+# EntityMemory (the mtm) remembers the entities a user mentioned, most
+# recent last, so a reassembly can bring one back with (@type), e.g.
+#   reasmb: How is the weather in (@location) today?
+# When the session hasn't mentioned a location, that reassembly is passed
+# over like a decomp that didn't match.
+
+import random
+import time
+from collections import OrderedDict
+
+#limits for new sessions
+stm_capacity = 20
+stm_ttl = 3600
+mtm_capacity = 50
+mtm_ttl = 24 * 3600
+
+
+class ShortTermMemory:
+    __slots__ = ('capacity', 'ttl', 'items')
+
+    def __init__(self, capacity=None, ttl=None):
+        self.capacity = stm_capacity if capacity is None else capacity
+        self.ttl = stm_ttl if ttl is None else ttl
+        # [(expires, reply)], in no particular order
+        self.items = []
+
+    def add(self, reply):
+        if not reply or not self.capacity:
+            return
+        item = (time.time() + self.ttl, reply)
+        if len(self.items) < self.capacity:
+            self.items.append(item)
+        else:
+            self.items[random.randrange(len(self.items))] = item
+
+    def _take(self, index):
+        items = self.items
+        item = items[index]
+        items[index] = items[-1]
+        items.pop()
+        return item
+
+    #removes and returns a random reply that hasn't expired, or None
+    def recall(self):
+        now = time.time()
+        while self.items:
+            expires, reply = self._take(random.randrange(len(self.items)))
+            if expires >= now:
+                return reply
+        return None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getstate__(self):
+        return self.capacity, self.ttl, self.items
+
+    def __setstate__(self, state):
+        self.capacity, self.ttl, self.items = state
+
+
+class EntityMemory:
+    __slots__ = ('capacity', 'ttl', 'entities')
+
+    def __init__(self, capacity=None, ttl=None):
+        self.capacity = mtm_capacity if capacity is None else capacity
+        self.ttl = mtm_ttl if ttl is None else ttl
+        # lowercase text -> [text, type, mentions, last mentioned], least recent first
+        self.entities = OrderedDict()
+
+    def remember(self, text, type):
+        key = text.lower()
+        entity = self.entities.get(key)
+        if entity is None:
+            entity = self.entities[key] = [text, type.lower(), 0, 0]
+        else:
+            self.entities.move_to_end(key)
+        entity[2] += 1
+        entity[3] = time.time()
+        while len(self.entities) > self.capacity:
+            self.entities.popitem(last=False)
+
+    #the text of the most recently mentioned entity of type, or None
+    def recall(self, type):
+        oldest = time.time() - self.ttl
+        for text, entity_type, mentions, mentioned in reversed(self.entities.values()):
+            if mentioned < oldest:
+                return None
+            if entity_type == type:
+                return text
+        return None
+
+    def mentions(self, text):
+        entity = self.entities.get(text.lower())
+        return entity[2] if entity else 0
+
+    def __contains__(self, text):
+        return text.lower() in self.entities
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __getstate__(self):
+        return self.capacity, self.ttl, self.entities
+
+    def __setstate__(self, state):
+        self.capacity, self.ttl, self.entities = state
@@ -0,0 +1,87 @@
+# NORMALIZER
+# Turns input text into the word list the keys and decomps match against, in
+# one pass: runs of '.', ',' and ';' become single punctuation tokens, and
+# pre: substitutions are applied as each token is read. Every token comes
+# with its lowercase form, so matching never lowercases the input again.
+# post: substitutions on decomp captures use the same precompiled tables.
+# split_clauses cuts the tokens into clauses for phrase matching.
+
+import re
+
+#a run of one punctuation mark, or a word up to whitespace or punctuation
+TOKEN = re.compile(r'\.+|,+|;+|[^\s.,;]+')
+
+PUNCTUATION = '.,;'
+
+#punctuation tokens between clauses, and the last characters of a word that ends one
+SEPARATORS = frozenset(PUNCTUATION)
+CLAUSE_ENDS = '?!'
+
+
+#{word: (replacement words, lowercase replacement words)}
+def compile_table(table):
+    compiled = {}
+    for word, replacement in table.items():
+        replacement = tuple(w for w in replacement if w)
+        compiled[word.lower()] = (replacement, tuple(w.lower() for w in replacement))
+    return compiled
+
+
+class Normalizer:
+    def __init__(self, pres, posts):
+        self.pres = compile_table(pres)
+        self.posts = compile_table(posts)
+
+    #returns (words, lowered) for text, after pre: substitution
+    def tokenize(self, text):
+        words = []
+        lowered = []
+        pres = self.pres
+        for token in TOKEN.findall(text):
+            if token[0] in PUNCTUATION:
+                token = lower = token[0]
+            else:
+                lower = token.lower()
+            replacement = pres.get(lower)
+            if replacement is None:
+                words.append(token)
+                lowered.append(lower)
+            else:
+                words.extend(replacement[0])
+                lowered.extend(replacement[1])
+        return words, lowered
+
+    #post: substitution of the words of a decomp capture
+    def post(self, words):
+        posts = self.posts
+        output = []
+        for word in words:
+            replacement = posts.get(word.lower())
+            if replacement is None:
+                output.append(word)
+            else:
+                output.extend(replacement[0])
+        return output
+
+
+#returns ([(words, lowered)] of each clause, clause number of each token)
+#separators belong to no clause, their clause number is None
+def split_clauses(words, lowered):
+    clauses = []
+    clause_of = [None] * len(lowered)
+    start = 0
+    for position, token in enumerate(lowered):
+        if token in SEPARATORS:
+            end, following = position, position + 1
+        elif token[-1] in CLAUSE_ENDS:
+            end = following = position + 1
+        else:
+            continue
+        if start < end:
+            clause_of[start:end] = [len(clauses)] * (end - start)
+            clauses.append((words[start:end], lowered[start:end]))
+        start = following
+    if start < len(lowered):
+        clause_of[start:] = [len(clauses)] * (len(lowered) - start)
+        clauses.append((words[start:], lowered[start:]))
+    return clauses, clause_of
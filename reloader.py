@@ -0,0 +1,78 @@
+# RELOADER
+# Picks up script changes without a restart. A reload builds a whole new
+# engine on a background thread and then swaps it in with one assignment,
+# so turns already running finish on the engine they started with and no
+# turn waits for a parse. Session state lives outside the engine and
+# decomp ids are (key word, position), so conversations carry over.
+#
+#   reloader = Reloader(version, load, swap, loaded_sources, interval)
+#   reloader.check()    # per request: starts a reload check when one is due
+#   reloader.watch()    # or poll from a daemon thread, for long running processes
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Reloader:
+    # version: callable() -> the sources of the scripts as they are now
+    # load: callable() -> a new engine with a sources attribute
+    # swap: callable(engine) that makes engine the one answering
+    def __init__(self, version, load, swap, sources, interval=60):
+        self.version = version
+        self.load = load
+        self.swap = swap
+        self.sources = sources
+        self.interval = interval
+        self.checked = time.time()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.reloads = 0
+        #sources of the last reload that failed, not retried until they change
+        self.failed = None
+
+    #starts a background check if interval has passed since the last one
+    #returns straight away, the caller keeps answering with the loaded engine
+    def check(self):
+        if not self.interval or time.time() - self.checked < self.interval:
+            return False
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.checked = time.time()
+            self.thread = threading.Thread(target=self.reload, name='script-reload')
+            self.thread.daemon = True
+            self.thread.start()
+        return True
+
+    def watch(self):
+        def poll():
+            while True:
+                time.sleep(self.interval)
+                self.reload()
+        thread = threading.Thread(target=poll, name='script-watch')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    #loads and swaps in the scripts if they changed, a broken script is
+    #logged once and the loaded one keeps answering until it is fixed
+    def reload(self):
+        version = None
+        try:
+            version = self.version()
+            if version == self.sources or version == self.failed:
+                return False
+            started = time.time()
+            engine = self.load()
+            self.swap(engine)
+        except Exception:
+            self.failed = version
+            log.exception('Script reload failed, keeping the loaded scripts')
+            return False
+        self.sources = engine.sources
+        self.reloads += 1
+        log.info('Reloaded scripts in %.3fs', time.time() - started)
+        return True
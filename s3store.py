@@ -0,0 +1,130 @@
+# S3 SCRIPT STORE
+# Script sources for load_s3. S3Store talks to the bucket, LocalStore is a
+# directory laid out like the bucket, for running offline and in tests.
+# ScriptCache keeps downloaded scripts in /tmp addressed by ETag, so warm
+# and re-initialized containers only download scripts that changed.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class S3Store:
+    # client is a low level s3 client, which unlike a resource is thread safe
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def list(self, prefix):
+        objects = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                objects.append((item['Key'], item['ETag'].strip('"')))
+        return objects
+
+    def etag(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=key)['ETag'].strip('"')
+
+    # returns (None, etag) when the object still matches etag
+    def get(self, key, etag=None):
+        from botocore.exceptions import ClientError
+        kwargs = {'Bucket': self.bucket, 'Key': key}
+        if etag:
+            kwargs['IfNoneMatch'] = '"{}"'.format(etag)
+        try:
+            response = self.client.get_object(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return None, etag
+            raise
+        return response['Body'].read(), response['ETag'].strip('"')
+
+
+class LocalStore:
+    def __init__(self, root):
+        self.root = root
+
+    def list(self, prefix):
+        objects = []
+        directory = os.path.join(self.root, prefix)
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as file:
+                    objects.append((prefix + name, hashlib.md5(file.read()).hexdigest()))
+        return objects
+
+    def etag(self, key):
+        with open(os.path.join(self.root, key), 'rb') as file:
+            return hashlib.md5(file.read()).hexdigest()
+
+    def get(self, key, etag=None):
+        with open(os.path.join(self.root, key), 'rb') as file:
+            data = file.read()
+        digest = hashlib.md5(data).hexdigest()
+        if digest == etag:
+            return None, etag
+        return data, digest
+
+
+class ScriptCache:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.etags = {}
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        try:
+            with open(os.path.join(directory, 'etags.json')) as file:
+                self.etags = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def _path(self, etag):
+        return os.path.join(self.directory, etag + '.txt')
+
+    def read(self, etag):
+        try:
+            with open(self._path(etag), 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def write(self, key, etag, data):
+        # write then rename so concurrent containers never see half a file
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp, self._path(etag))
+        with self.lock:
+            self.etags[key] = etag
+
+    # returns (key, etag, data), downloading only when the cache is out of date
+    # etag is the listed etag, or None to ask the store with a conditional get
+    def fetch(self, store, key, etag=None):
+        if etag is not None:
+            data = self.read(etag)
+            if data is not None:
+                return key, etag, data
+            data, etag = store.get(key)
+        else:
+            known = self.etags.get(key)
+            if known is not None and not os.path.exists(self._path(known)):
+                known = None
+            data, etag = store.get(key, known)
+            if data is None:
+                return key, etag, self.read(etag)
+        self.write(key, etag, data)
+        return key, etag, data
+
+    def save(self):
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as file:
+            with self.lock:
+                json.dump(self.etags, file)
+        os.replace(temp, os.path.join(self.directory, 'etags.json'))
@@ -0,0 +1,269 @@
+# SCRIPT TABLES
+# Key/Decomp tables shared by the loaders, the load-time checks that turn
+# reassemblies into templates, and the precompiled script bundle: the parsed
+# tables plus compiled matchers pickled into one file, so a cold start can
+# skip parsing the text scripts.
+
+import hashlib
+import io
+import pickle
+import re
+import sys
+
+BUNDLE_MAGIC = b'HIGGINS BUNDLE\n'
+BUNDLE_VERSION = 10
+
+#attributes of Higgins that make up a loaded script
+SCRIPT_TABLES = ('initials', 'finals', 'follows', 'quits', 'lambdas',
+                 'pres', 'posts', 'synons', 'gazetteer', 'lexicon',
+                 'keys', 'xnone', 'index', 'normalizer', 'local',
+                 'minDelay', 'maxDelay', 'delay')
+
+
+class Key:
+    __slots__ = ('word', 'weight', 'decomps')
+
+    def __init__(self, word, weight, decomps):
+        self.word = word
+        self.weight = weight
+        self.decomps = decomps
+
+
+class Decomp:
+    __slots__ = ('parts', 'save', 'reasmbs', 'id', 'matcher', 'templates', 'stateless')
+
+    def __init__(self, parts, save, reasmbs):
+        self.parts = parts
+        self.save = save
+        self.reasmbs = reasmbs
+        #(key word, position), set by Higgins.compile and used to key session state
+        self.id = None
+        self.matcher = None
+        #Reassembly templates parallel to reasmbs, set by compile_reassemblies
+        self.templates = None
+        #see is_stateless, set by compile_reassemblies
+        self.stateless = False
+
+
+#punctuation a capture is cut at when it is inserted into a reply
+CAPTURE_STOPS = frozenset([',', '.', ';'])
+
+
+class ScriptError(ValueError):
+    pass
+
+
+#a reassembly word that is a capture or an entity recall, with any punctuation
+#after it, e.g. (2)? or (@location).
+INSERT = re.compile(r'\((@?)([^()]*)\)([^\w()]*)$')
+
+
+class Suffix(str):
+    # punctuation a reassembly puts right after a capture or entity, it is
+    # joined to the word before it instead of becoming a word of its own
+    __slots__ = ()
+
+
+class Reassembly:
+    # action: None for a reply, or 'goto', 'lambda' or 'confirm' (rendered
+    # like a reply)
+    # target: the Key of a goto, the action name of a lambda
+    # parts: reply words, capture positions as ints counting from 0, and
+    # (type,) for the last entity of that type the session mentioned, and a
+    # Suffix after either when the script puts punctuation right after it
+    __slots__ = ('action', 'target', 'parts')
+
+    def __init__(self, action, target, parts):
+        self.action = action
+        self.target = target
+        self.parts = parts
+
+    #returns None when a remembered entity the reply needs isn't in mtm
+    def render(self, results, mtm=None):
+        output = []
+        for part in self.parts:
+            if part.__class__ is tuple:
+                text = mtm.recall(part[0]) if mtm is not None else None
+                if text is None:
+                    return None
+                output.append(text)
+            elif part.__class__ is int:
+                insert = results[part]
+                for position, word in enumerate(insert):
+                    if word in CAPTURE_STOPS:
+                        insert = insert[:position]
+                        break
+                output.extend(insert)
+            elif part.__class__ is Suffix:
+                if output:
+                    output[-1] += part
+                else:
+                    output.append(str(part))
+            else:
+                output.append(part)
+        return output
+
+
+#the number of capture groups a decomp's matches have, one per '*' and '@root'
+def capture_count(decomp):
+    return sum(1 for part in decomp.parts if part == '*' or part.startswith('@'))
+
+
+#returns the template for reasmb words, adding what is wrong with it to errors
+def compile_reassembly(words, decomp, keys, where, errors):
+    action = target = None
+    if words[0] == 'goto':
+        if len(words) < 2 or words[1] not in keys:
+            errors.append('{}: goto to unknown key {}'.format(where, ' '.join(words[1:])))
+            return None
+        return Reassembly('goto', keys[words[1]], ())
+    if words[0] == 'lambda':
+        if len(words) < 2 or not words[1]:
+            errors.append('{}: lambda without an action name'.format(where))
+            return None
+        action, target, words = 'lambda', words[1], words[2:]
+    elif words[0] == 'confirm':
+        action = 'confirm'
+    captures = capture_count(decomp)
+    parts = []
+    for word in words:
+        if not word:
+            continue
+        insert = INSERT.match(word) if word[0] == '(' else None
+        if insert is None:
+            parts.append(word)
+            continue
+        entity, name, suffix = insert.groups()
+        if entity:
+            if not name:
+                errors.append('{}: {} names no entity type'.format(where, word))
+                continue
+            parts.append((name.lower(),))
+        else:
+            try:
+                index = int(name)
+            except ValueError:
+                index = 0
+            if index < 1 or index > captures:
+                errors.append('{}: {} but the decomp has {} captures'.format(where, word, captures))
+                continue
+            parts.append(index - 1)
+        if suffix:
+            parts.append(Suffix(suffix))
+    return Reassembly(action, target, tuple(parts))
+
+
+#checks every key and turns its reassemblies into templates, goto targets
+#become direct references; raises ScriptError listing everything wrong
+def compile_reassemblies(keys, synons):
+    errors = []
+    for key in keys.values():
+        for position, decomp in enumerate(key.decomps):
+            where = 'key {} decomp {} ({})'.format(key.word, position, ' '.join(decomp.parts))
+            for part in decomp.parts:
+                if part.startswith('@') and part[1:] not in synons:
+                    errors.append('{}: unknown synonym root {}'.format(where, part))
+            if not decomp.reasmbs:
+                errors.append('{}: no reasmb lines'.format(where))
+            decomp.templates = [compile_reassembly(words, decomp, keys, where, errors)
+                                for words in decomp.reasmbs]
+    for cycle in goto_cycles(keys):
+        errors.append('goto cycle: {}'.format(' -> '.join(cycle)))
+    if errors:
+        raise ScriptError('Invalid script:\n  ' + '\n  '.join(errors))
+    #only once every template compiled, a rejected reasmb has None for one
+    for key in keys.values():
+        for decomp in key.decomps:
+            decomp.stateless = is_stateless(decomp)
+
+
+#True when the reply of a matched decomp depends only on the input and the
+#reassembly rotation: it doesn't save to memory, run an action or goto, recall
+#an entity, or render empty, so it always answers once it matches
+def is_stateless(decomp):
+    if decomp.save:
+        return False
+    for template in decomp.templates:
+        if template.action not in (None, 'confirm'):
+            return False
+        if not any(part.__class__ in (str, Suffix) for part in template.parts):
+            return False
+        if any(part.__class__ is tuple for part in template.parts):
+            return False
+    return True
+
+
+#returns the goto cycles between keys, each as the list of key words around it
+def goto_cycles(keys):
+    edges = {}
+    for key in keys.values():
+        edges[key.word] = sorted(set(template.target.word for decomp in key.decomps
+                                     for template in decomp.templates or ()
+                                     if template is not None and template.action == 'goto'))
+    cycles = []
+    done = set()
+    for start in sorted(edges):
+        # depth first, path holds the keys on the current chain
+        path = []
+        on_path = set()
+        stack = [(start, iter(edges[start]))]
+        path.append(start)
+        on_path.add(start)
+        while stack:
+            word, targets = stack[-1]
+            target = next(targets, None)
+            if target is None:
+                stack.pop()
+                path.pop()
+                on_path.discard(word)
+                done.add(word)
+            elif target in on_path:
+                cycles.append(path[path.index(target):] + [target])
+            elif target not in done:
+                stack.append((target, iter(edges[target])))
+                path.append(target)
+                on_path.add(target)
+    return cycles
+
+
+#md5 of a script file, the same value S3 reports as the ETag of a simple upload
+def file_digest(path):
+    with open(path, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+#sources maps each script file name to its digest, used to detect a stale bundle
+def write_bundle(path, tables, sources):
+    header = {
+        'version': BUNDLE_VERSION,
+        'python': tuple(sys.version_info[:2]),
+        'sources': sources,
+    }
+    with open(path, 'wb') as file:
+        file.write(BUNDLE_MAGIC)
+        pickle.dump(header, file, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(tables, file, pickle.HIGHEST_PROTOCOL)
+
+
+#returns the tables, or None if the bundle is missing or stale
+def read_bundle(path, sources):
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+    if not data.startswith(BUNDLE_MAGIC):
+        return None
+    stream = io.BytesIO(data)
+    stream.seek(len(BUNDLE_MAGIC))
+    try:
+        header = pickle.load(stream)
+        if header.get('version') != BUNDLE_VERSION:
+            return None
+        if header.get('python') != tuple(sys.version_info[:2]):
+            return None
+        if header.get('sources') != sources:
+            return None
+        return pickle.load(stream)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
@@ -0,0 +1,160 @@
+# SCRIPT PARSER
+# The one parser for "tag: content" script lines, for local files and
+# scripts downloaded from s3 alike. It takes the script as byte chunks of
+# any size, decodes them as UTF-8 as they arrive and keeps the key/decomp
+# state between chunks, so a file is read in large blocks and parsed as it
+# streams in. Problems are reported as ScriptError with the file and line.
+#
+#   parse_file(higgins, 'scripts/core/script.txt')
+#   parse_chunks(higgins, body.iter_chunks(), 'script.txt')
+
+import codecs
+import logging
+
+from script import Key, Decomp, ScriptError
+
+log = logging.getLogger(__name__)
+
+#bytes read at a time from a script file
+CHUNK_SIZE = 1 << 16
+
+
+class ScriptParser:
+    # tables is the object parsed lines are added to, a Higgins
+    def __init__(self, tables, name='<script>'):
+        self.tables = tables
+        self.name = name
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.pending = ''
+        self.lineno = 0
+        self.key = None
+        self.decomp = None
+        self.handlers = dict((name[4:], getattr(self, name)) for name in dir(self)
+                             if name.startswith('tag_'))
+
+    def feed(self, chunk):
+        lines = (self.pending + self._decode(chunk)).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.parse_line(line)
+
+    def close(self):
+        line = self.pending + self._decode(b'', True)
+        self.pending = ''
+        if line:
+            self.parse_line(line)
+
+    def _decode(self, chunk, final=False):
+        try:
+            return self.decoder.decode(chunk, final)
+        except UnicodeDecodeError as e:
+            # lines before the bad byte are not parsed yet, count them in
+            lineno = self.lineno + self.pending.count('\n') + chunk[:e.start].count(b'\n') + 1
+            self.error(lineno, 'not valid UTF-8 ({})'.format(e.reason))
+
+    def error(self, lineno, message):
+        raise ScriptError('{}:{}: {}'.format(self.name, lineno, message))
+
+    def parse_line(self, line):
+        self.lineno += 1
+        if not line.strip():
+            return
+        tag, colon, content = line.partition(':')
+        if not colon:
+            self.error(self.lineno, 'expected "tag: content", got {!r}'.format(line.strip()))
+        tag = tag.strip()
+        handler = self.handlers.get(tag)
+        if handler is None:
+            # tags this version doesn't know are left for the scripts that use them
+            log.debug('%s:%s: skipping unknown tag %s', self.name, self.lineno, tag)
+            return
+        handler(content.strip())
+
+    def tag_initial(self, content):
+        self.tables.initials.append(content)
+
+    def tag_final(self, content):
+        self.tables.finals.append(content)
+
+    def tag_follow(self, content):
+        self.tables.follows.append(content)
+
+    def tag_lambda(self, content):
+        self.tables.lambdas.append(content)
+
+    def tag_quit(self, content):
+        self.tables.quits.append(content)
+
+    def tag_pre(self, content):
+        parts = content.split(' ')
+        self.tables.pres[parts[0]] = parts[1:]
+
+    def tag_post(self, content):
+        parts = content.split(' ')
+        self.tables.posts[parts[0]] = parts[1:]
+
+    def tag_synon(self, content):
+        parts = content.split(' ')
+        self.tables.synons[parts[0]] = frozenset(part.lower() for part in parts if part)
+
+    def tag_entity(self, content):
+        parts = content.split(' ')
+        self.tables.gazetteer.append((parts[0], ' '.join(parts[1:])))
+
+    def tag_sentiment(self, content):
+        parts = content.split(' ')
+        for word in parts[1:]:
+            self.tables.lexicon[word] = parts[0]
+
+    #delay: <min ms> <max ms> [ms per character], how long a reply takes to type
+    def tag_delay(self, content):
+        try:
+            values = [int(part) for part in content.split()]
+        except ValueError:
+            values = []
+        if len(values) not in (2, 3):
+            self.error(self.lineno, 'expected "delay: <min ms> <max ms> [ms per character]"')
+        self.tables.minDelay, self.tables.maxDelay = values[:2]
+        if len(values) == 3:
+            self.tables.delay = values[2]
+
+    def tag_key(self, content):
+        parts = content.split(' ')
+        weight = 1
+        if len(parts) > 1 and parts[-1].isdigit():
+            weight = int(parts.pop())
+        word = ' '.join(parts)
+        if not word:
+            self.error(self.lineno, 'key without a word')
+        self.key = Key(word, weight, [])
+        self.decomp = None
+        self.tables.keys[word] = self.key
+
+    def tag_decomp(self, content):
+        if self.key is None:
+            self.error(self.lineno, 'decomp before any key')
+        parts = content.split(' ')
+        save = False
+        if parts[0] == '$':
+            save = True
+            parts = parts[1:]
+        self.decomp = Decomp(parts, save, [])
+        self.key.decomps.append(self.decomp)
+
+    def tag_reasmb(self, content):
+        if self.decomp is None:
+            self.error(self.lineno, 'reasmb before any decomp of this key')
+        self.decomp.reasmbs.append(content.split(' '))
+
+
+#chunks is any iterable of bytes: a file read in blocks, an s3 body, one bytes object
+def parse_chunks(tables, chunks, name='<script>'):
+    parser = ScriptParser(tables, name)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+
+def parse_file(tables, path):
+    with open(path, 'rb') as file:
+        parse_chunks(tables, iter(lambda: file.read(CHUNK_SIZE), b''), str(path))
@@ -0,0 +1,539 @@
+# HIGGINS SERVER
+# A long running asyncio front end, for self-hosting Higgins on one box
+# instead of invoking the Lambda per message. The compiled scripts stay
+# warm, sessions run concurrently, and only the standard library is used.
+#
+#   python server.py [--host 0.0.0.0] [--port 8080] [--scripts local|s3] [--processes N]
+#
+#   GET  /           the chat page in html/, which talks to /ws
+#   GET  /ws         websocket, one JSON message per turn each way, and
+#                    {"session": ..., "body": ..., "follow": true} prompts
+#   POST /respond    {"session": ..., "text": ...} -> {"body": ...}
+#                    {"session": ..., "texts": [...]} -> one JSON line per reply,
+#                    each streamed as soon as it is ready
+#   GET  /health
+#
+# Turns for one session run in order; turns for different sessions run on a
+# pool of worker threads. The backpressure works in three ways:
+#   - A websocket stops reading once queue_size of its messages are waiting.
+#   - Every connection waits for a free worker.
+#   - HTTP answers 503 when more than max_pending turns are queued.
+# With --processes the turns are answered by pre-forked worker processes,
+# see workers.py, and this process only handles the connections.
+#
+# Replies are held back for the typing delay the engine gives them (the
+# delay: script line) after the worker is done with the turn, so waiting
+# replies only cost a heap entry, see TypingScheduler.
+#
+# A websocket session that goes quiet for --idle seconds after its last
+# reply is sent a follow: prompt, up to follow_limit in a row, and then a
+# final: line. The page no longer has to poll, see IdleTracker.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import mimetypes
+import os
+import struct
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('higgins.server')
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+#opcodes of websocket frames
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+#largest request body or websocket message accepted
+MAX_MESSAGE = 64 * 1024
+
+STATUS = {200: 'OK', 101: 'Switching Protocols', 400: 'Bad Request', 404: 'Not Found',
+          405: 'Method Not Allowed', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class WebSocket:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+
+    #returns the next text message, or None once the client closed
+    async def receive(self):
+        message = b''
+        while True:
+            head = await self.reader.readexactly(2)
+            final = head[0] & 0x80
+            opcode = head[0] & 0x0F
+            length = head[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            if length + len(message) > MAX_MESSAGE:
+                await self.close(1009)
+                return None
+            mask = await self.reader.readexactly(4) if head[1] & 0x80 else None
+            payload = await self.reader.readexactly(length)
+            if mask:
+                payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+            if opcode == CLOSE:
+                await self.close(1000)
+                return None
+            if opcode == PING:
+                await self.send_frame(PONG, payload)
+                continue
+            if opcode == PONG:
+                continue
+            message += payload
+            if final:
+                return message.decode('utf-8', 'replace')
+
+    async def send(self, text):
+        await self.send_frame(TEXT, text.encode('utf-8'))
+
+    async def send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        async with self.write_lock:
+            self.writer.write(head + payload)
+            # waits while the client is slow to read what was already sent
+            await self.writer.drain()
+
+    async def close(self, code):
+        try:
+            await self.send_frame(CLOSE, struct.pack('!H', code))
+        except ConnectionError:
+            pass
+
+
+class TypingScheduler:
+    # every reply waiting for its typing delay is in one heap, and one loop
+    # timer is set for the earliest. A session's replies are typed one after
+    # another: a reply's delay starts once the session's previous one is out.
+    def __init__(self):
+        self.heap = []
+        self.order = itertools.count()
+        self.timer = None
+        #{session id: when its last scheduled reply goes out}
+        self.typing = {}
+
+    #returns a future that is done once the session has typed for delay seconds
+    def wait(self, session_id, delay):
+        loop = asyncio.get_running_loop()
+        due = max(loop.time(), self.typing.get(session_id, 0)) + delay
+        self.typing[session_id] = due
+        future = loop.create_future()
+        heapq.heappush(self.heap, (due, next(self.order), session_id, future))
+        if self.heap[0][3] is future:
+            self._arm(loop)
+        return future
+
+    def _arm(self, loop):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = loop.call_at(self.heap[0][0], self._release, loop)
+
+    def _release(self, loop):
+        self.timer = None
+        now = loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, session_id, future = heapq.heappop(self.heap)
+            if self.typing.get(session_id) == due:
+                del self.typing[session_id]
+            # a reply whose client went away was cancelled
+            if not future.done():
+                future.set_result(None)
+        if self.heap:
+            self._arm(loop)
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class IdleTracker:
+    # calls on_idle(session id) for sessions not touched for idle seconds.
+    # Every touch pushes (due, session) onto one heap with one loop timer
+    # for the earliest entry; entries a later touch replaced are skipped as
+    # they come up, so touching is a push and never a search
+    def __init__(self, idle, on_idle):
+        self.idle = idle
+        self.on_idle = on_idle
+        self.heap = []
+        self.timer = None
+        #{session id: when it goes idle}
+        self.due = {}
+
+    def touch(self, session_id):
+        loop = asyncio.get_running_loop()
+        due = loop.time() + self.idle
+        self.due[session_id] = due
+        heapq.heappush(self.heap, (due, session_id))
+        if self.timer is None or due < self.timer.when():
+            self._arm(loop)
+
+    def forget(self, session_id):
+        self.due.pop(session_id, None)
+
+    def _arm(self, loop):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = loop.call_at(self.heap[0][0], self._release, loop)
+
+    def _release(self, loop):
+        self.timer = None
+        now = loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            due, session_id = heapq.heappop(self.heap)
+            if self.due.get(session_id) == due:
+                del self.due[session_id]
+                self.on_idle(session_id)
+        if self.heap:
+            self._arm(loop)
+
+    def __len__(self):
+        return len(self.due)
+
+
+class Server:
+    # converse: callable(session id, text) -> {'body': ..., 'delay': ms}, run on worker threads
+    # typing: hold replies back for their delay
+    # follow: callable(session id, final) -> {'body': ..., 'delay': ms}, the
+    # prompt for a websocket session quiet for idle seconds
+    def __init__(self, converse, workers=8, max_pending=256, queue_size=16, static_dir='html',
+                 typing=True, follow=None, idle=30, follow_limit=3):
+        self.converse = converse
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.workers = asyncio.Semaphore(workers)
+        self.max_pending = max_pending
+        self.queue_size = queue_size
+        self.static_dir = os.path.abspath(static_dir)
+        self.pending = 0
+        self.session_locks = weakref.WeakValueDictionary()
+        self.scheduler = TypingScheduler() if typing else None
+        self.follow = follow
+        self.follow_limit = follow_limit
+        self.idle = IdleTracker(idle, self.on_idle) if follow and idle else None
+        #{session id: its open websocket}, and follow prompts sent since it last spoke
+        self.sockets = {}
+        self.followed = {}
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle, host, port, limit=MAX_MESSAGE)
+
+    #answers one turn, after the session's earlier turns
+    async def turn(self, session_id, text):
+        return await self.answer(session_id, self.converse, text)
+
+    #runs call(session id, argument) on a worker after the session's earlier turns,
+    #returns the body once its typing delay is up
+    async def answer(self, session_id, call, argument):
+        lock = self.session_locks.get(session_id)
+        if lock is None:
+            lock = self.session_locks[session_id] = asyncio.Lock()
+        self.pending += 1
+        try:
+            async with lock, self.workers:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self.pool, call, session_id, argument)
+        finally:
+            self.pending -= 1
+        # the session's lock and the worker are free again while the reply waits
+        delay = response.get('delay')
+        if delay and self.scheduler is not None:
+            await self.scheduler.wait(session_id, delay / 1000.0)
+        return response['body']
+
+    def on_idle(self, session_id):
+        socket = self.sockets.get(session_id)
+        if socket is not None:
+            asyncio.ensure_future(self.follow_up(session_id, socket))
+
+    async def follow_up(self, session_id, socket):
+        count = self.followed.get(session_id, 0)
+        # set even when 0, a message from the session takes it out
+        self.followed[session_id] = count
+        final = count >= self.follow_limit
+        try:
+            body = await self.answer(session_id, self.follow, final)
+        except Exception:
+            log.exception('Follow up failed')
+            return
+        # the session spoke or left while the prompt was made
+        if self.sockets.get(session_id) is not socket or self.followed.get(session_id) != count:
+            return
+        if body:
+            try:
+                await socket.send(json.dumps({'session': session_id, 'body': body, 'follow': True}))
+            except ConnectionError:
+                return
+        self.followed[session_id] = count + 1
+        if not final:
+            self.idle.touch(session_id)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self.websocket(reader, writer, headers)
+                    break
+                await self.route(writer, method, path, headers, body)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except ProtocolError as e:
+            await self.reply(writer, 400, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            log.exception('Request failed')
+        finally:
+            writer.close()
+
+    #returns (method, path, headers, body), or None when the connection closed
+    async def read_request(self, reader):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise ProtocolError('headers too large')
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, path, version = lines[0].split(' ')
+        except ValueError:
+            raise ProtocolError('bad request line')
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0) or 0)
+        if length > MAX_MESSAGE:
+            raise ProtocolError('body too large')
+        body = await reader.readexactly(length) if length else b''
+        return method, path.split('?')[0], headers, body
+
+    async def route(self, writer, method, path, headers, body):
+        if path == '/health':
+            await self.reply(writer, 200, {'pending': self.pending,
+                                           'typing': len(self.scheduler or ()),
+                                           'idle_tracked': len(self.idle or ())})
+        elif path == '/respond':
+            if method != 'POST':
+                await self.reply(writer, 405, {'error': 'POST only'})
+                return
+            await self.respond(writer, body)
+        elif method == 'GET':
+            await self.static(writer, path)
+        else:
+            await self.reply(writer, 404, {'error': 'not found'})
+
+    async def respond(self, writer, body):
+        try:
+            request = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise ProtocolError('body is not json')
+        if not isinstance(request, dict):
+            raise ProtocolError('body is not a json object')
+        session_id = str(request.get('session') or uuid.uuid4())
+        texts = request.get('texts')
+        if texts is not None and not isinstance(texts, list):
+            raise ProtocolError('texts is not a list')
+        if self.pending + len(texts or [None]) > self.max_pending:
+            await self.reply(writer, 503, {'error': 'busy'}, {'Retry-After': '1'})
+            return
+        if texts is None:
+            try:
+                output = await self.turn(session_id, request.get('text', ''))
+            except Exception:
+                log.exception('Turn failed')
+                await self.reply(writer, 500, {'error': 'turn failed'})
+                return
+            await self.reply(writer, 200, {'session': session_id, 'body': output})
+            return
+        # one json line per reply, written as each one is ready
+        writer.write(self.head(200, 'application/x-ndjson', {'Transfer-Encoding': 'chunked'}))
+        for text in texts:
+            try:
+                reply = {'session': session_id, 'body': await self.turn(session_id, text)}
+            except Exception:
+                log.exception('Turn failed')
+                reply = {'session': session_id, 'error': 'turn failed'}
+            line = (json.dumps(reply) + '\n').encode('utf-8')
+            writer.write(b'%x\r\n%s\r\n' % (len(line), line))
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    async def websocket(self, reader, writer, headers):
+        key = headers.get('sec-websocket-key')
+        if not key:
+            raise ProtocolError('missing Sec-WebSocket-Key')
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(self.head(101, None, {'Upgrade': 'websocket', 'Connection': 'Upgrade',
+                                           'Sec-WebSocket-Accept': accept}))
+        await writer.drain()
+        socket = WebSocket(reader, writer)
+        session_id = str(uuid.uuid4())
+        self.sockets[session_id] = socket
+        # messages are read into a bounded queue and answered in order, when it
+        # is full the socket isn't read, and tcp slows the client down
+        queue = asyncio.Queue(self.queue_size)
+
+        async def answer():
+            while True:
+                text = await queue.get()
+                if text is None:
+                    return
+                ended = False
+                try:
+                    body = await self.turn(session_id, text)
+                    # a quit word ends the conversation: it is answered with a
+                    # final: line once, and not followed up
+                    if body is None and self.follow is not None:
+                        ended = True
+                        body = await self.answer(session_id, self.follow, True)
+                    reply = {'session': session_id, 'body': body}
+                except Exception:
+                    log.exception('Turn failed')
+                    reply = {'session': session_id, 'error': 'turn failed'}
+                await socket.send(json.dumps(reply))
+                if ended:
+                    if self.idle is not None:
+                        self.idle.forget(session_id)
+                # the idle clock starts once the reply is out
+                elif self.idle is not None and queue.empty():
+                    self.idle.touch(session_id)
+
+        answering = asyncio.ensure_future(answer())
+        try:
+            while not answering.done():
+                message = await socket.receive()
+                if message is None:
+                    break
+                try:
+                    request = json.loads(message)
+                except ValueError:
+                    request = {'text': message}
+                if not isinstance(request, dict):
+                    request = {'text': message}
+                if request.get('session') and str(request['session']) != session_id:
+                    self.leave(session_id, socket)
+                    session_id = str(request['session'])
+                    self.sockets[session_id] = socket
+                self.followed.pop(session_id, None)
+                if self.idle is not None:
+                    self.idle.forget(session_id)
+                await queue.put(request.get('text', ''))
+            if not answering.done():
+                await queue.put(None)
+                await answering
+        finally:
+            answering.cancel()
+            self.leave(session_id, socket)
+
+    def leave(self, session_id, socket):
+        if self.sockets.get(session_id) is socket:
+            del self.sockets[session_id]
+            self.followed.pop(session_id, None)
+            if self.idle is not None:
+                self.idle.forget(session_id)
+
+    async def static(self, writer, path):
+        if path == '/':
+            path = '/index.html'
+        if path == '/config.js':
+            # tells the page to use the websocket instead of invoking the lambda
+            body = b"window.HIGGINS_SERVER = (location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '/ws'\n"
+            writer.write(self.head(200, 'application/javascript', {'Content-Length': len(body)}) + body)
+            await writer.drain()
+            return
+        file = os.path.abspath(os.path.join(self.static_dir, path.lstrip('/')))
+        if not file.startswith(self.static_dir + os.sep) or not os.path.isfile(file):
+            await self.reply(writer, 404, {'error': 'not found'})
+            return
+        with open(file, 'rb') as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(file)[0] or 'application/octet-stream'
+        writer.write(self.head(200, content_type, {'Content-Length': len(body)}) + body)
+        await writer.drain()
+
+    def head(self, status, content_type, headers):
+        lines = ['HTTP/1.1 {} {}'.format(status, STATUS[status])]
+        if content_type:
+            lines.append('Content-Type: ' + content_type)
+        for name, value in headers.items():
+            lines.append('{}: {}'.format(name, value))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def reply(self, writer, status, document, headers=None):
+        body = json.dumps(document).encode('utf-8')
+        headers = dict(headers or {}, **{'Content-Length': len(body)})
+        writer.write(self.head(status, 'application/json', headers) + body)
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve Higgins over http and websockets')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--scripts', default='local', choices=['local', 's3'],
+                        help='load the scripts from scripts/ or from the bucket')
+    parser.add_argument('--workers', type=int, default=8, help='turns answered at once')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes, more than 1 forks them after the scripts load')
+    parser.add_argument('--idle', type=float, default=30,
+                        help='seconds a websocket session is quiet before a follow up prompt, 0 for none')
+    parser.add_argument('--no-typing', action='store_true',
+                        help='send replies as soon as they are ready, without a typing delay')
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    import higginsV2
+    higginsV2.init(args.scripts)
+    higginsV2.detection_pools(args.workers)
+
+    converse = higginsV2.converse
+    if args.processes > 1:
+        from workers import WorkerPool
+        converse = WorkerPool(higginsV2.converse, args.processes, prepare=higginsV2.open_sessions).converse
+
+    async def serve():
+        server = Server(converse, workers=args.workers, typing=not args.no_typing,
+                        follow=higginsV2.follow_up, idle=args.idle)
+        listening = await server.start(args.host, args.port)
+        log.info('Serving on %s:%s', args.host, args.port)
+        async with listening:
+            await listening.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
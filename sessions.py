@@ -0,0 +1,140 @@
+# SESSIONS
+# Per-conversation state, kept apart from the loaded script so every
+# conversation can share one compiled script. SessionStore evicts the
+# least recently used sessions past its capacity and any session idle for
+# longer than its ttl. Backends hold the records: MemoryBackend by default,
+# SqliteBackend when sessions should survive a restart.
+
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from memory import ShortTermMemory, EntityMemory
+
+
+class Session:
+    __slots__ = ('id', 'stm', 'mtm', 'rotations', 'last_key', 'touched')
+
+    def __init__(self, id):
+        self.id = id
+        self.stm = ShortTermMemory()
+        self.mtm = EntityMemory()
+        # decomp id -> index of the next reassembly to use
+        self.rotations = {}
+        self.last_key = None
+        self.touched = time.time()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+        # sessions saved before memory was bounded kept a list and a dict
+        if isinstance(self.stm, list):
+            stm = ShortTermMemory()
+            for reply in self.stm[-stm.capacity:]:
+                stm.add(reply)
+            self.stm = stm
+        if isinstance(self.mtm, dict):
+            mtm = EntityMemory()
+            for text in self.mtm:
+                mtm.remember(text, '')
+            self.mtm = mtm
+
+
+class MemoryBackend:
+    def __init__(self):
+        # ordered from least to most recently saved
+        self.sessions = OrderedDict()
+
+    def load(self, id):
+        return self.sessions.get(id)
+
+    # evict: optional (capacity, oldest) to sweep with after storing
+    def store(self, session, evict=None):
+        self.sessions[session.id] = session
+        self.sessions.move_to_end(session.id)
+        if evict is not None:
+            self.evict(*evict)
+
+    def evict(self, capacity, oldest):
+        sessions = self.sessions
+        while sessions:
+            id, session = next(iter(sessions.items()))
+            if len(sessions) <= capacity and session.touched >= oldest:
+                break
+            del sessions[id]
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class SqliteBackend:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('create table if not exists sessions '
+                        '(id text primary key, touched real, record blob)')
+        self.db.execute('create index if not exists sessions_touched on sessions (touched)')
+        self.db.commit()
+
+    def load(self, id):
+        row = self.db.execute('select record from sessions where id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    # evict: optional (capacity, oldest) to sweep with, in the same commit
+    def store(self, session, evict=None):
+        record = pickle.dumps(session, pickle.HIGHEST_PROTOCOL)
+        self.db.execute('insert or replace into sessions values (?, ?, ?)',
+                        (session.id, session.touched, record))
+        if evict is not None:
+            self._sweep(*evict)
+        self.db.commit()
+
+    def evict(self, capacity, oldest):
+        self._sweep(capacity, oldest)
+        self.db.commit()
+
+    def _sweep(self, capacity, oldest):
+        self.db.execute('delete from sessions where touched < ?', (oldest,))
+        self.db.execute('delete from sessions where id not in '
+                        '(select id from sessions order by touched desc limit ?)', (capacity,))
+
+    def __len__(self):
+        return self.db.execute('select count(*) from sessions').fetchone()[0]
+
+
+class SessionStore:
+    # evict_every: saves between eviction sweeps. The memory backend can sweep
+    # every time, a sqlite sweep scans the table and wants a larger value
+    def __init__(self, backend=None, capacity=10000, ttl=1800, evict_every=1):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.capacity = capacity
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.saves = 0
+        self.lock = threading.Lock()
+
+    # returns the stored session, or a new one if it is unknown or expired
+    def get(self, id):
+        with self.lock:
+            session = self.backend.load(id)
+        if session is None or session.touched < time.time() - self.ttl:
+            session = Session(id)
+        return session
+
+    def save(self, session):
+        session.touched = time.time()
+        with self.lock:
+            self.saves += 1
+            evict = None
+            if self.saves % self.evict_every == 0:
+                evict = (self.capacity, session.touched - self.ttl)
+            self.backend.store(session, evict)
+
+    def __len__(self):
+        return len(self.backend)
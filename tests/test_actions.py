@@ -0,0 +1,97 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from actions import Action, ActionExecutor, LocalInvoker, parse_action
+
+
+def test_answer_within_the_deadline():
+    invoker = LocalInvoker({'weather': lambda payload: 'Sunny in ' + payload['text']})
+    executor = ActionExecutor(invoker)
+    assert executor.run(Action('weather', 'weather', timeout=1), {'text': 'Leeds'}) == 'Sunny in Leeds'
+    assert invoker.calls == [('weather', {'text': 'Leeds'})]
+
+
+def test_missed_deadline_falls_back():
+    release = threading.Event()
+    executor = ActionExecutor(LocalInvoker({'slow': lambda payload: release.wait(5) and 'late'}))
+    started = time.time()
+    assert executor.run(Action('slow', 'slow', timeout=0.05), {}) is None
+    assert time.time() - started < 1
+    release.set()
+
+
+def test_failed_call_falls_back():
+    def broken(payload):
+        raise RuntimeError('down')
+    executor = ActionExecutor(LocalInvoker({'broken': broken}))
+    assert executor.run(Action('broken', 'broken', timeout=1), {}) is None
+
+
+def test_event_action_is_fired_and_not_waited_for():
+    done = threading.Event()
+    release = threading.Event()
+
+    def log(payload):
+        release.wait(5)
+        done.set()
+        return 'ignored'
+    executor = ActionExecutor(LocalInvoker({'log': log}))
+    assert executor.run(parse_action('log event', 1.0), {}) is None
+    assert not done.is_set()
+    release.set()
+    assert done.wait(5)
+
+
+def test_cached_action_reuses_the_answer():
+    invoker = LocalInvoker({'faq': lambda payload: 'answer'})
+    executor = ActionExecutor(invoker)
+    action = parse_action('faq cache 60', 1.0)
+    assert executor.run(action, {'text': 'opening hours'}) == 'answer'
+    assert executor.run(action, {'text': 'opening hours'}) == 'answer'
+    assert len(invoker.calls) == 1
+
+
+def test_engine_runs_actions_through_a_local_invoker(tmp_path):
+    import higginsV2
+    from sessions import Session
+    script = tmp_path / 'script.txt'
+    script.write_text('key: weather\n'
+                      '  decomp: * weather *\n'
+                      '    reasmb: lambda weather I can\'t see outside.\n'
+                      'key: xnone\n'
+                      '  decomp: *\n'
+                      '    reasmb: Go on.\n')
+    engine = higginsV2.Higgins()
+    engine.loadfile(str(script))
+    engine.compile()
+    saved = higginsV2.actions.invoker, higginsV2.detect_entities_enabled, higginsV2.detect_sentiment_enabled
+    higginsV2.detect_entities_enabled = higginsV2.detect_sentiment_enabled = False
+    try:
+        higginsV2.use_invoker(LocalInvoker({'weather': lambda payload: 'Rain, ' + payload['text']}))
+        assert engine.respond('how is the weather', Session('a')) == 'Rain, how is the weather'
+        higginsV2.use_invoker(LocalInvoker({'weather': lambda payload: None}))
+        assert engine.respond('how is the weather', Session('b')) == "I can't see outside."
+    finally:
+        higginsV2.actions.invoker, higginsV2.detect_entities_enabled, higginsV2.detect_sentiment_enabled = saved
+
+
+def test_local_invoker_is_selected_by_config(monkeypatch):
+    import higginsV2
+    monkeypatch.setattr(higginsV2, 'action_invoker', 'local')
+    invoker = higginsV2.make_invoker()
+    assert isinstance(invoker, LocalInvoker)
+    assert invoker.handlers is higginsV2.local_actions
+
+
+def test_cached_action_is_shared_between_sessions():
+    invoker = LocalInvoker({'faq': lambda payload: 'answer'})
+    executor = ActionExecutor(invoker)
+    action = parse_action('faq cache 60', 1.0)
+    executor.run(action, {'action': 'faq', 'text': 'opening hours', 'session': 'a'})
+    executor.run(action, {'action': 'faq', 'text': 'opening hours', 'session': 'b'})
+    executor.run(action, {'action': 'faq', 'text': 'prices', 'session': 'b'})
+    assert len(invoker.calls) == 2
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comprehend import CachedComprehend, FakeComprehend
+
+
+def make(ttl=3600, **kwargs):
+    fake = FakeComprehend(entities={'London': 'LOCATION'}, sentiments={'sad': 'NEGATIVE'})
+    return fake, CachedComprehend(fake, capacity=16, ttl=ttl, **kwargs)
+
+
+def test_repeated_text_is_a_hit():
+    fake, comprehend = make()
+    assert comprehend.detect_sentiment('I am sad') == 'NEGATIVE'
+    # whitespace differences are the same text
+    assert comprehend.detect_sentiment('I  am sad ') == 'NEGATIVE'
+    assert fake.calls == 1
+    assert comprehend.sentiment.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+
+def test_entities_and_sentiment_are_cached_apart():
+    fake, comprehend = make()
+    assert comprehend.detect_entities('I live in London')[0]['Type'] == 'LOCATION'
+    comprehend.detect_sentiment('I live in London')
+    assert fake.calls == 2
+
+
+def test_expired_entries_are_asked_again(monkeypatch):
+    fake, comprehend = make(ttl=60)
+    comprehend.detect_sentiment('hello')
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    comprehend.detect_sentiment('hello')
+    assert fake.calls == 2
+
+
+def test_batch_only_sends_misses():
+    fake, comprehend = make()
+    comprehend.detect_sentiment('I am sad')
+    assert comprehend.batch_detect_sentiment(['I am sad', 'hello', 'hello']) == \
+        ['NEGATIVE', 'NEUTRAL', 'NEUTRAL']
+    assert fake.calls == 2
+    assert comprehend.sentiment.stats()['size'] == 2
+
+
+def test_client_is_connected_on_first_miss():
+    connected = []
+
+    def connect():
+        connected.append(True)
+        return FakeComprehend()
+    comprehend = CachedComprehend(connect=connect)
+    assert not connected
+    comprehend.detect_sentiment('hello')
+    comprehend.detect_sentiment('hello')
+    assert connected == [True]
+
+
+def test_persisted_cache_starts_warm(tmp_path):
+    fake, comprehend = make(cache_dir=str(tmp_path))
+    comprehend.detect_sentiment('I am sad')
+    comprehend.sentiment.save()
+    fake, warm = make(cache_dir=str(tmp_path))
+    assert warm.detect_sentiment('I am sad') == 'NEGATIVE'
+    assert fake.calls == 0
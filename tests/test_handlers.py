@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import higginsV2
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    script = tmp_path / 'script.txt'
+    script.write_text('key: hello\n'
+                      '  decomp: * hello *\n'
+                      '    reasmb: Hi.\n'
+                      '    reasmb: Hello again.\n'
+                      'key: xnone\n'
+                      '  decomp: *\n'
+                      '    reasmb: Go on.\n')
+    monkeypatch.setattr(higginsV2, 'local_files', lambda: [script])
+    monkeypatch.setattr(higginsV2, 'bundle_path', str(tmp_path / 'missing.bundle'))
+    monkeypatch.setattr(higginsV2, 'session_db', None)
+    monkeypatch.setattr(higginsV2, 'reload_interval', 0)
+    monkeypatch.setattr(higginsV2, 'detect_entities_enabled', False)
+    monkeypatch.setattr(higginsV2, 'detect_sentiment_enabled', False)
+    monkeypatch.setattr(higginsV2, 'higgins', None)
+    monkeypatch.setattr(higginsV2, 'sessions', None)
+    monkeypatch.setattr(higginsV2, 'reloader', None)
+    higginsV2.init('local')
+
+
+def test_anonymous_callers_get_their_own_session(engine):
+    first = higginsV2.lambda_handler({'Payload': 'hello'}, None)
+    second = higginsV2.lambda_handler({'Payload': 'hello'}, None)
+    assert first['session'] != second['session']
+    assert first['body'] == second['body'] == 'Hi.'
+    carried = higginsV2.lambda_handler({'Payload': 'hello', 'session': first['session']}, None)
+    assert carried['body'] == 'Hello again.'
+
+
+def test_batch_returns_the_session_of_each_output(engine):
+    response = higginsV2.lambda_handler({'Batch': [{'text': 'hello'}, {'text': 'hello', 'session': 'x'},
+                                                   {'text': 'hello', 'session': 'x'}]}, None)
+    assert response['body'] == ['Hi.', 'Hi.', 'Hello again.']
+    new, named, again = response['sessions']
+    assert (named, again) == ('x', 'x')
+    assert new not in ('x', '')
+    carried = higginsV2.lambda_handler({'Batch': [{'text': 'hello', 'session': new}]}, None)
+    assert carried['body'] == ['Hello again.']
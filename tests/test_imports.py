@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import IMPORT_PROBE, LAZY_MODULES
+
+
+# startup cost: these import in a fresh interpreter without loading boto3,
+# the aws clients are only made when a feature first uses them
+@pytest.mark.parametrize('module', LAZY_MODULES)
+def test_imports_without_boto3(module):
+    env = dict(os.environ)
+    # inside lambda the scripts load at import, which does need the clients
+    env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+    done = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module)], cwd=ROOT, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert done.returncode == 0, done.stderr
+    row = json.loads(done.stdout.strip().splitlines()[-1])
+    assert not row['boto3']
@@ -0,0 +1,96 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import DecompMatcher
+
+SYNONS = {
+    'belief': frozenset(['belief', 'feel', 'think', 'believe', 'wish']),
+    'family': frozenset(['family', 'mother', 'father', 'sister']),
+}
+
+PATTERNS = [
+    ['*'],
+    ['*', 'you', '*'],
+    ['*', 'i', 'remember', '*'],
+    ['i', '*', 'you'],
+    ['*', 'you', '*', 'me', '*'],
+    ['*', '@belief', '*'],
+    ['*', 'my', '@family', '*'],
+    ['*', '@belief', 'you', '*'],
+    ['@family', '*'],
+    ['*', 'i', '*', 'i', '*'],
+]
+
+VOCABULARY = ['i', 'I', 'you', 'me', 'my', 'remember', 'feel', 'think', 'mother',
+              'Father', 'the', 'dog', 'wish']
+
+
+# the recursive matcher the engines used before DecompMatcher
+def old_match(parts, words, synons):
+    def step(parts, words, results):
+        if not parts and not words:
+            return True
+        if not parts or (not words and parts != ['*']):
+            return False
+        if parts[0] == '*':
+            for index in range(len(words), -1, -1):
+                results.append(words[:index])
+                if step(parts[1:], words[index:], results):
+                    return True
+                results.pop()
+            return False
+        elif parts[0].startswith('@'):
+            root = parts[0][1:]
+            if root not in synons:
+                raise ValueError("Unknown synonym root {}".format(root))
+            if not words[0].lower() in synons[root]:
+                return False
+            results.append([words[0]])
+            return step(parts[1:], words[1:], results)
+        elif parts[0].lower() != words[0].lower():
+            return False
+        else:
+            return step(parts[1:], words[1:], results)
+
+    results = []
+    if step(parts, words, results):
+        return results
+    return None
+
+
+def new_match(parts, words):
+    return DecompMatcher(parts, SYNONS).match(words, [word.lower() for word in words])
+
+
+def captures(parts):
+    return sum(1 for part in parts if part == '*' or part.startswith('@'))
+
+
+def test_same_captures_as_the_recursive_matcher():
+    generator = random.Random(7)
+    compared = 0
+    for _ in range(3000):
+        parts = generator.choice(PATTERNS)
+        words = [generator.choice(VOCABULARY) for _ in range(generator.randint(0, 8))]
+        old = old_match(parts, words, SYNONS)
+        if old is not None and len(old) != captures(parts):
+            # the old matcher leaked synonym captures, see the test below
+            continue
+        assert new_match(parts, words) == old, (parts, words)
+        compared += 1
+    assert compared > 2500
+
+
+def test_synonym_capture_is_dropped_when_the_rest_fails():
+    # the old matcher appended [feel] for @belief on a split that then failed,
+    # the '*' popped that instead of its own group, leaving a stale
+    # ['i', 'think', 'you'] in front that shifted every (n) after it
+    parts = ['*', '@belief', 'you', '*']
+    words = ['i', 'think', 'you', 'feel']
+    old = old_match(parts, words, SYNONS)
+    new = new_match(parts, words)
+    assert new == [['i'], ['think'], ['feel']]
+    assert old == [['i', 'think', 'you'], ['i'], ['think'], ['feel']]
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import higginsV2
+from actions import LocalInvoker
+from reloader import Reloader
+from sessions import Session
+
+XNONE = ('key: xnone\n'
+         '  decomp: *\n'
+         '    reasmb: Go on.\n')
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setattr(higginsV2, 'detect_entities_enabled', False)
+    monkeypatch.setattr(higginsV2, 'detect_sentiment_enabled', False)
+    monkeypatch.setattr(higginsV2, 'phrase_matching', 'off')
+
+
+def engine_for(tmp_path, keys):
+    script = tmp_path / 'script.txt'
+    script.write_text(keys + XNONE)
+    engine = higginsV2.Higgins()
+    engine.loadfile(str(script))
+    engine.compile()
+    return engine
+
+
+def test_memo_hit_still_rotates_reassemblies(tmp_path):
+    engine = engine_for(tmp_path, 'key: hello\n'
+                                  '  decomp: * hello *\n'
+                                  '    reasmb: Hi.\n'
+                                  '    reasmb: Hello (2).\n'
+                                  '    reasmb: Hey.\n')
+    session = Session('a')
+    replies = [engine.respond('hello there', session) for _ in range(4)]
+    assert replies == ['Hi.', 'Hello there.', 'Hey.', 'Hi.']
+    assert engine.memo.hits == 3
+    # another session starts its own rotation from the memo
+    assert engine.respond('hello there', Session('b')) == 'Hi.'
+
+
+@pytest.mark.parametrize('keys', [
+    # $ saves to memory, the next decomp answers
+    'key: hello\n  decomp: $ * hello *\n    reasmb: You said hello.\n'
+    '  decomp: *\n    reasmb: Hi.\n',
+    'key: hello\n  decomp: * hello *\n    reasmb: goto xnone\n',
+    'key: hello\n  decomp: * hello *\n    reasmb: lambda greet Hi.\n',
+    'key: hello\n  decomp: * hello *\n    reasmb: Hello from (@location).\n',
+])
+def test_stateful_decomps_are_never_memoized(tmp_path, monkeypatch, keys):
+    engine = engine_for(tmp_path, keys)
+    monkeypatch.setattr(higginsV2.actions, 'invoker', LocalInvoker({'greet': lambda payload: 'Hey.'}))
+    session = Session('a')
+    session.mtm.remember('Leeds', 'location')
+    first = engine.respond('hello there', session)
+    assert first is not None
+    engine.respond('hello there', session)
+    assert not engine.keys['hello'].decomps[0].stateless
+    assert len(engine.memo.entries) == 0
+    assert engine.memo.hits == 0
+
+
+def test_reloaded_engine_starts_with_an_empty_memo(tmp_path, monkeypatch):
+    script = tmp_path / 'script.txt'
+    script.write_text('key: hello\n  decomp: * hello *\n    reasmb: Hi.\n' + XNONE)
+    monkeypatch.setattr(higginsV2, 'local_files', lambda: [script])
+    monkeypatch.setattr(higginsV2, 'bundle_path', str(tmp_path / 'missing.bundle'))
+    monkeypatch.setattr(higginsV2, 'higgins', None)
+    higginsV2.install(higginsV2.reload_local())
+    session = Session('a')
+    assert higginsV2.current().respond('hello', session) == 'Hi.'
+    assert len(higginsV2.current().memo.entries) == 1
+
+    script.write_text('key: hello\n  decomp: * hello *\n    reasmb: Welcome back.\n' + XNONE)
+    reloader = Reloader(higginsV2.local_sources, higginsV2.reload_local, higginsV2.install,
+                        higginsV2.current().sources, 0)
+    assert reloader.reload()
+    assert len(higginsV2.current().memo.entries) == 0
+    assert higginsV2.current().respond('hello', session) == 'Welcome back.'
@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s3store import LocalStore, ScriptCache
+
+
+class CountingStore(LocalStore):
+    # counts gets, and the gets that sent a body back
+    def __init__(self, root):
+        LocalStore.__init__(self, root)
+        self.gets = 0
+        self.downloads = 0
+
+    def get(self, key, etag=None):
+        self.gets += 1
+        data, etag = LocalStore.get(self, key, etag)
+        if data is not None:
+            self.downloads += 1
+        return data, etag
+
+
+def make_store(tmp_path, text=b'key: hello\n'):
+    (tmp_path / 'bucket' / 'scripts').mkdir(parents=True)
+    (tmp_path / 'bucket' / 'scripts' / 'core.txt').write_bytes(text)
+    return CountingStore(str(tmp_path / 'bucket'))
+
+
+def test_conditional_get_reuses_the_cached_copy(tmp_path):
+    store = make_store(tmp_path)
+    cache = ScriptCache(str(tmp_path / 'cache'))
+    key, etag, data = cache.fetch(store, 'scripts/core.txt')
+    assert data == b'key: hello\n'
+    assert store.downloads == 1
+    # unchanged: the store answers the conditional get without a body
+    assert cache.fetch(store, 'scripts/core.txt') == (key, etag, data)
+    assert (store.gets, store.downloads) == (2, 1)
+
+
+def test_changed_script_is_downloaded_again(tmp_path):
+    store = make_store(tmp_path)
+    cache = ScriptCache(str(tmp_path / 'cache'))
+    first = cache.fetch(store, 'scripts/core.txt')[1]
+    (tmp_path / 'bucket' / 'scripts' / 'core.txt').write_bytes(b'key: bye\n')
+    key, etag, data = cache.fetch(store, 'scripts/core.txt')
+    assert data == b'key: bye\n'
+    assert etag != first
+    assert store.downloads == 2
+
+
+def test_listed_etag_in_cache_skips_the_store(tmp_path):
+    store = make_store(tmp_path)
+    cache = ScriptCache(str(tmp_path / 'cache'))
+    [(key, etag)] = store.list('scripts/')
+    cache.fetch(store, key, etag)
+    assert cache.fetch(store, key, etag) == (key, etag, b'key: hello\n')
+    assert store.gets == 1
+
+
+def test_saved_etags_survive_a_new_cache(tmp_path):
+    store = make_store(tmp_path)
+    cache = ScriptCache(str(tmp_path / 'cache'))
+    etag = cache.fetch(store, 'scripts/core.txt')[1]
+    cache.save()
+    warm = ScriptCache(str(tmp_path / 'cache'))
+    assert warm.etags == {'scripts/core.txt': etag}
+    assert warm.fetch(store, 'scripts/core.txt')[2] == b'key: hello\n'
+    assert store.downloads == 1
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from script import Key, Decomp, ScriptError, compile_reassemblies
+
+
+def keys_with(reasmb):
+    return {
+        'hello': Key('hello', 1, [Decomp(['*', 'hello', '*'], False, [reasmb.split(' ')])]),
+        'xnone': Key('xnone', 1, [Decomp(['*'], False, [['Go', 'on.']])]),
+    }
+
+
+def test_goto_unknown_key_raises_script_error():
+    with pytest.raises(ScriptError) as error:
+        compile_reassemblies(keys_with('goto nokey'), {})
+    assert 'goto to unknown key nokey' in str(error.value)
+
+
+def test_lambda_without_name_raises_script_error():
+    with pytest.raises(ScriptError) as error:
+        compile_reassemblies(keys_with('lambda'), {})
+    assert 'lambda without an action name' in str(error.value)
+
+
+def test_plain_reply_is_stateless():
+    keys = keys_with('Hi there (2)')
+    compile_reassemblies(keys, {})
+    assert keys['hello'].decomps[0].stateless
+
+
+def test_capture_followed_by_punctuation_is_a_capture():
+    keys = keys_with('Why (2)?')
+    compile_reassemblies(keys, {})
+    template = keys['hello'].decomps[0].templates[0]
+    assert template.render([['well'], ['you', 'there']]) == ['Why', 'you', 'there?']
+
+
+def test_capture_out_of_range_with_punctuation_raises_script_error():
+    with pytest.raises(ScriptError) as error:
+        compile_reassemblies(keys_with('Why (3)?'), {})
+    assert '(3)? but the decomp has 2 captures' in str(error.value)
@@ -0,0 +1,99 @@
+# WORKER POOL
+# Pre-forked worker processes for answering turns on every core. Matching
+# is pure python, so one process tops out at one core whatever its thread
+# count. The scripts are loaded and compiled once in the parent before the
+# fork, and the workers share those pages copy-on-write (the gc is frozen
+# first so collections don't touch, and copy, them).
+#
+# Each session is routed to a worker by a hash of its id, so its
+# short-term memory stays in that worker. Worker state is not shared: every
+# worker has its own sessions and engine, and reloads its scripts itself.
+#
+#   pool = WorkerPool(higginsV2.converse, 4, prepare=open_sessions)
+#   pool.converse(session_id, text)    # thread safe, blocks for the reply
+
+import gc
+import logging
+import multiprocessing
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+class WorkerError(Exception):
+    pass
+
+
+def serve(connection, converse, prepare):
+    if prepare is not None:
+        prepare()
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        try:
+            connection.send((True, converse(*request)))
+        except Exception as e:
+            log.exception('Turn failed in worker')
+            connection.send((False, repr(e)))
+
+
+class WorkerPool:
+    # converse: callable(session id, text) run in the workers, it must be
+    # reachable from the parent as it is at fork time
+    # prepare: optional callable each worker runs once after the fork
+    def __init__(self, converse, processes, prepare=None):
+        self.converse_in_worker = converse
+        self.prepare = prepare
+        self.context = multiprocessing.get_context('fork')
+        self.workers = [None] * processes
+        self.locks = [threading.Lock() for _ in range(processes)]
+        gc.collect()
+        gc.freeze()
+        for index in range(processes):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=serve, name='higgins-worker-{}'.format(index),
+                                       args=(child, self.converse_in_worker, self.prepare))
+        process.daemon = True
+        process.start()
+        child.close()
+        self.workers[index] = (process, parent)
+
+    #a stable hash, the same session goes to the same worker across restarts
+    def route(self, session_id):
+        return zlib.crc32(session_id.encode('utf-8')) % len(self.workers)
+
+    def converse(self, session_id, text):
+        index = self.route(session_id)
+        with self.locks[index]:
+            process, connection = self.workers[index]
+            try:
+                connection.send((session_id, text))
+                ok, result = connection.recv()
+            except (EOFError, OSError):
+                # the worker died, its sessions went with it
+                log.error('Worker %s exited with %s, restarting it', index, process.exitcode)
+                connection.close()
+                self._spawn(index)
+                raise WorkerError('worker {} exited'.format(index))
+        if not ok:
+            raise WorkerError(result)
+        return result
+
+    def close(self):
+        for index, (process, connection) in enumerate(self.workers):
+            with self.locks[index]:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+                connection.close()
+            process.join(5)
+        gc.unfreeze()